@@ -0,0 +1,409 @@
+"""
+Benchmarks for the blockchain node
+
+run "python benchmark.py" to print the results, "python benchmark.py hashing chain"
+to run only some of them, "-o results.json" to save them and "-b results.json"
+to compare a later run against the saved one
+"""
+import gzip
+import hashlib
+import json
+import sys
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+
+import project
+from project import TRANSACTION_TYPES, Blockchain, codec, json_default, merkle_root, record_from_dict, search_proof
+from tieredchain import TieredChain
+
+
+def legacy_hash_loop(last_proof, last_hash, nonces):
+    """
+    The nonce loop proof_of_work used to run, one valid_proof call per nonce
+    """
+    for proof in range(nonces):
+        guess = f'{last_proof}{proof}{last_hash}'.encode()
+        guess_hash = hashlib.sha256(guess).hexdigest()
+        guess_hash[:4] == "0000"
+
+
+def optimised_hash_loop(last_proof, last_hash, nonces):
+    """
+    The search_proof loop over every nonce below nonces, at the real DIFFICULTY
+    """
+    # search_proof stops at the first valid proof, so start again just after
+    # each one until every nonce has been hashed
+    start = 0
+    while start < nonces:
+        proof = search_proof(last_proof, last_hash, start, nonces)
+        start = nonces if proof is None else proof + 1
+
+
+def best_time(run, repeat, setup=None):
+    """
+    Fastest of repeat runs of run(), in seconds. With setup, every run is
+    run(setup()) and setup is not timed.
+    """
+    best = None
+    for _ in range(repeat):
+        if setup is None:
+            started = perf_counter()
+            run()
+        else:
+            values = setup()
+            started = perf_counter()
+            run(values)
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def synthetic_transactions(count, offset=0):
+    """
+    count transactions cycling through every transaction type
+    """
+    records = list(TRANSACTION_TYPES.values())
+    transactions = []
+    for i in range(offset, offset + count):
+        record = records[i % len(records)]
+        values = {field: f'{field}-{i}' for field in record.fields}
+        values['PatientID'] = i
+        transactions.append(record(**values))
+    return transactions
+
+
+def synthetic_chain(blocks, transactions_per_block):
+    """
+    A Blockchain with blocks mined blocks of transactions_per_block transactions
+    """
+    blockchain = Blockchain()
+    blockchain.mempool.capacity = max(blockchain.mempool.capacity, transactions_per_block)
+    for i in range(blocks - 1):
+        blockchain.new_transactions(synthetic_transactions(transactions_per_block, i * transactions_per_block))
+        blockchain.new_block(blockchain.proof_of_work(blockchain.last_block), None)
+    return blockchain
+
+
+def bench_hashing(args):
+    blockchain = Blockchain()
+    last_block = blockchain.last_block
+    last_proof = last_block['proof']
+    last_hash = blockchain.hash(last_block)
+    nonces = args.nonces
+
+    legacy = best_time(lambda: legacy_hash_loop(last_proof, last_hash, nonces), args.repeat)
+    optimised = best_time(lambda: optimised_hash_loop(last_proof, last_hash, nonces), args.repeat)
+
+    return {
+        'valid_proof_loop_hashes_per_s': nonces / legacy,
+        'search_proof_hashes_per_s': nonces / optimised,
+    }
+
+
+def bench_proof_of_work(args):
+    # Time to a proof varies a lot from block to block, so mine a run of them
+    blockchain = Blockchain()
+    started = perf_counter()
+    for _ in range(args.proofs):
+        blockchain.new_block(blockchain.proof_of_work(blockchain.last_block), None)
+    return {
+        'proof_of_work_s': (perf_counter() - started) / args.proofs,
+    }
+
+
+def bench_block_hash(args):
+    results = {}
+    for size in args.block_sizes:
+        transactions = synthetic_transactions(size)
+        legacy_block = {
+            'index': 2,
+            'timestamp': 0.0,
+            'transactions': transactions,
+            'proof': 0,
+            'previous_hash': '0' * 64,
+        }
+        merkle_block = dict(legacy_block, merkle_root=merkle_root(transactions, 1))
+        codec_block = dict(legacy_block, merkle_root=merkle_root(transactions, 2), version=2)
+
+        results[f'block_hash_full_{size}_tx_s'] = best_time(lambda: Blockchain.hash(legacy_block), args.repeat)
+        results[f'block_hash_header_{size}_tx_s'] = best_time(lambda: Blockchain.hash(merkle_block), args.repeat)
+        results[f'block_hash_codec_header_{size}_tx_s'] = best_time(lambda: Blockchain.hash(codec_block), args.repeat)
+        results[f'merkle_root_{size}_tx_s'] = best_time(lambda: merkle_root(transactions, 1), args.repeat)
+        results[f'merkle_root_codec_{size}_tx_s'] = best_time(lambda: merkle_root(transactions, 2), args.repeat)
+    return results
+
+
+def bench_codec(args):
+    # A page of blocks as /chain/blocks sends it, in JSON and in the binary encoding
+    results = {}
+    for size in args.block_sizes:
+        transactions = synthetic_transactions(size)
+        block = {
+            'index': 2,
+            'timestamp': 0.0,
+            'transactions': transactions,
+            'merkle_root': merkle_root(transactions),
+            'proof': 0,
+            'previous_hash': '0' * 64,
+            'version': 2,
+        }
+        response = {'blocks': [block], 'length': 2}
+        json_body = json.dumps(response, default=json_default).encode()
+        codec_body = codec.encode(response)
+
+        results[f'json_encode_{size}_tx_s'] = best_time(lambda: json.dumps(response, default=json_default).encode(), args.repeat)
+        results[f'codec_encode_{size}_tx_s'] = best_time(lambda: codec.encode(response), args.repeat)
+        results[f'json_decode_{size}_tx_s'] = best_time(lambda: json.loads(json_body, object_hook=record_from_dict), args.repeat)
+        results[f'codec_decode_{size}_tx_s'] = best_time(lambda: codec.decode(codec_body, object_hook=record_from_dict), args.repeat)
+        results[f'json_{size}_tx_bytes'] = len(json_body)
+        results[f'codec_{size}_tx_bytes'] = len(codec_body)
+        results[f'json_gzip_{size}_tx_bytes'] = len(gzip.compress(json_body, compresslevel=6))
+        results[f'codec_gzip_{size}_tx_bytes'] = len(gzip.compress(codec_body, compresslevel=6))
+    return results
+
+
+def bench_chain(args):
+    results = {}
+    for length in args.chain_lengths:
+        blockchain = synthetic_chain(length, args.block_transactions)
+        chain = list(blockchain.chain)
+        results[f'valid_chain_{length}_blocks_s'] = best_time(lambda: blockchain.valid_chain(chain), args.repeat)
+    return results
+
+
+def bench_query(args):
+    results = {}
+    for length in args.chain_lengths:
+        blockchain = synthetic_chain(length, args.block_transactions)
+        blockchain.build_query_index()
+        times = blockchain.block_times
+        # The last tenth of the chain, like a report on the last night of a long running node
+        start, end = times[length * 9 // 10], times[-1]
+
+        def scan():
+            return [
+                (block, position)
+                for block in blockchain.chain
+                if start <= block['timestamp'] < end
+                for position, transaction in enumerate(block['transactions'])
+                if transaction.type == 'lab'
+            ]
+
+        results[f'query_scan_{length}_blocks_s'] = best_time(scan, args.repeat)
+        results[f'query_index_{length}_blocks_s'] = best_time(lambda: blockchain.query(start, end, 'lab'), args.repeat)
+    return results
+
+
+def bench_http(args):
+    client = project.app.test_client()
+    blockchain = project.blockchain
+    project.blockchain = synthetic_chain(args.http_blocks, args.block_transactions)
+    project.blockchain.mempool.capacity = 10 ** 9
+
+    try:
+        count = args.http_transactions
+        routes = {
+            'desk': '/transactions/newdesk',
+            'admission': '/transactions/newadmin',
+            'assessment': '/transactions/newassessment',
+            'doctor': '/transactions/newdoctor',
+            'lab': '/transactions/newlab',
+            'dispensary': '/transactions/newDisp',
+        }
+        # Every run posts transactions that are not in the chain or posted
+        # before, or they would all be turned away as duplicates
+        offsets = iter(range(args.http_blocks * args.block_transactions, 10 ** 12, count))
+
+        def fresh_transactions():
+            return synthetic_transactions(count, next(offsets))
+
+        def single(transactions):
+            for transaction in transactions:
+                client.post(routes[transaction.type], json=transaction.to_dict())
+
+        def batch(transactions):
+            typed = [dict(transaction.to_dict(), type=transaction.type) for transaction in transactions]
+            for start in range(0, count, args.batch_size):
+                client.post('/transactions/batch', json=typed[start:start + args.batch_size])
+
+        def deskchain(query):
+            def run():
+                for _ in range(args.http_requests):
+                    client.get(f'/deskchain{query}').get_data()
+            return run
+
+        return {
+            'ingest_single_tx_per_s': count / best_time(single, args.repeat, fresh_transactions),
+            'ingest_batch_tx_per_s': count / best_time(batch, args.repeat, fresh_transactions),
+            'deskchain_requests_per_s': args.http_requests / best_time(deskchain(''), args.repeat),
+            'deskchain_stream_requests_per_s': args.http_requests / best_time(deskchain('?stream=true'), args.repeat),
+            'deskchain_page_requests_per_s': args.http_requests / best_time(deskchain('?start=1&limit=10'), args.repeat),
+        }
+    finally:
+        project.blockchain = blockchain
+
+
+def allocated_per_item(build, count):
+    """
+    Bytes allocated per item by build(i) for count items that are all kept alive
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = [build(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # The list holding the items is not part of what they cost
+    return (after - before) / len(items) - 8
+
+
+def bench_memory(args):
+    results = {}
+    for name, record in TRANSACTION_TYPES.items():
+        # Field values are shared between items, so only the containers are measured
+        values = {field: field for field in record.fields}
+
+        results[f'memory_{name}_dict_bytes'] = allocated_per_item(lambda i: dict(values, PatientID=i), args.transactions)
+        results[f'memory_{name}_record_bytes'] = allocated_per_item(lambda i: record(**dict(values, PatientID=i)), args.transactions)
+    return results
+
+
+def bench_tiered(args):
+    def synthetic_blocks(start, count):
+        return [
+            {
+                'index': index + 1,
+                'timestamp': float(index),
+                'transactions': synthetic_transactions(args.block_transactions, index * args.block_transactions),
+                'merkle_root': '0' * 64,
+                'proof': index,
+                'previous_hash': '0' * 64,
+                'version': 2,
+            }
+            for index in range(start, start + count)
+        ]
+
+    def resident(chain):
+        # Blocks are made a batch at a time and dropped once in chain, so
+        # only what chain keeps is still allocated at the end
+        tracemalloc.start()
+        for start in range(0, args.tiered_blocks, 100):
+            blocks = synthetic_blocks(start, min(100, args.tiered_blocks - start))
+            chain.extend(blocks, [f'{block["index"]:064x}' for block in blocks])
+            del blocks
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size
+
+    class ListChain(list):
+        def extend(self, blocks, hashes):
+            list.extend(self, blocks)
+
+    with tempfile.TemporaryDirectory() as path:
+        plain = ListChain()
+        tiered = TieredChain(path, codec.encode, codec.decode, hot_blocks=args.hot_blocks)
+        length = args.tiered_blocks
+
+        def recent():
+            for _ in range(args.http_requests * 100):
+                tiered[-1]
+
+        return {
+            f'memory_{length}_blocks_bytes': resident(plain),
+            f'memory_{length}_tiered_blocks_bytes': resident(tiered),
+            f'tiered_{length}_blocks_read_s': best_time(lambda: list(tiered), args.repeat),
+            'tiered_recent_reads_per_s': args.http_requests * 100 / best_time(recent, args.repeat),
+        }
+
+
+BENCHMARKS = {
+    'hashing': bench_hashing,
+    'pow': bench_proof_of_work,
+    'blockhash': bench_block_hash,
+    'codec': bench_codec,
+    'chain': bench_chain,
+    'query': bench_query,
+    'http': bench_http,
+    'memory': bench_memory,
+    'tiered': bench_tiered,
+}
+
+# Benchmarks that build synthetic chains run at this difficulty, so building
+# them is quick. Checking a proof costs one hash whatever the difficulty.
+SYNTHETIC_DIFFICULTY = 1
+
+
+def higher_is_better(metric):
+    return metric.endswith('_per_s')
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print results next to a baseline
+    :return: <list> metrics that got worse by more than tolerance
+    """
+    regressions = []
+    for metric, value in results.items():
+        before = baseline.get(metric)
+        if not before:
+            print(f'{metric:<40} {value:>14.6g}')
+            continue
+
+        change = value / before - 1
+        worse = -change if higher_is_better(metric) else change
+        flag = ''
+        if worse > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(metric)
+        print(f'{metric:<40} {value:>14.6g} {before:>14.6g} {change:>+8.1%}{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*', help=f'benchmarks to run out of {", ".join(BENCHMARKS)}, all if none given')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='compare against results saved with -o')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='slowdown against the baseline that counts as a regression')
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='runs per measurement, the best one is kept')
+    parser.add_argument('-n', '--nonces', default=200000, type=int, help='nonces hashed per run')
+    parser.add_argument('--proofs', default=5, type=int, help='proofs found for the proof of work benchmark')
+    parser.add_argument('--block-sizes', default=[10, 100, 1000], type=int, nargs='+', help='transactions per block for block hashing and encoding')
+    parser.add_argument('--chain-lengths', default=[100, 1000], type=int, nargs='+', help='blocks per chain for validation')
+    parser.add_argument('--block-transactions', default=10, type=int, help='transactions per block in synthetic chains')
+    parser.add_argument('--http-blocks', default=200, type=int, help='blocks in the chain served by /deskchain')
+    parser.add_argument('--http-transactions', default=2000, type=int, help='transactions posted per ingest run')
+    parser.add_argument('--http-requests', default=20, type=int, help='/deskchain requests per run')
+    parser.add_argument('--batch-size', default=500, type=int, help='transactions per /transactions/batch request')
+    parser.add_argument('--tiered-blocks', default=5000, type=int, help='blocks in the chain for the tiered storage benchmark')
+    parser.add_argument('--hot-blocks', default=1000, type=int, help='blocks whose transactions stay in memory in the tiered storage benchmark')
+    parser.add_argument('-t', '--transactions', default=100000, type=int, help='transactions built per type for the memory benchmark')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        difficulty = project.DIFFICULTY
+        if name in ('chain', 'query', 'http'):
+            project.DIFFICULTY = SYNTHETIC_DIFFICULTY
+        try:
+            results.update(BENCHMARKS[name](args))
+        finally:
+            project.DIFFICULTY = difficulty
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'difficulty': project.DIFFICULTY, 'results': results}, f, indent=2, sort_keys=True)
+
+    if regressions:
+        sys.exit(1)
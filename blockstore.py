@@ -0,0 +1,301 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+
+class BlockStore:
+    """
+    Append-only on-disk block store.
+
+    Blocks are appended to blocks.dat as records of a length, a CRC32 and the
+    block as JSON. blocks.idx holds the offset and hash of every record, so
+    opening a store only reads the index, blocks themselves are read through
+    a memory map of blocks.dat when they are asked for.
+
+    The store can be used like the list of blocks it replaces: it supports
+    len(), indexing, slicing and iteration.
+
+    Other processes can open the same store readonly and call refresh() to
+    see what the process that writes to it appended or truncated since.
+    """
+
+    RECORD_HEADER = struct.Struct('>II')
+    INDEX_ENTRY = struct.Struct('>Q32s')
+
+    def __init__(self, path, hash_block, cache_size=1024, sync=True, default=None, object_hook=None, readonly=False):
+        """
+        :param path: Directory the store lives in, created if missing
+        :param hash_block: <callable> Hashes a block, used to index records
+                           that were written without their index entry
+        :param cache_size: <int> Number of decoded blocks kept in memory
+        :param sync: <bool> fsync every write, so a block that was appended
+                     survives a power cut and not only a crash of the node
+        :param default: <callable> JSON encoder hook for objects in blocks
+        :param object_hook: <callable> JSON decoder hook for objects in blocks
+        :param readonly: <bool> Only read a store another process writes to.
+                         Records are read with plain reads instead of a
+                         memory map, which would fault if the writer
+                         truncated the file under it.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.segment_path = os.path.join(path, 'blocks.dat')
+        self.index_path = os.path.join(path, 'blocks.idx')
+        self.hash_block = hash_block
+        self.cache_size = cache_size
+        self.sync = sync
+        self.default = default
+        self.object_hook = object_hook
+        self.readonly = readonly
+
+        self.offsets = []
+        self.hashes = []
+        self._cache = OrderedDict()
+        self._map = None
+        self._lock = threading.RLock()
+
+        if readonly:
+            self._segment = open(self.segment_path, 'rb')
+            self._index = open(self.index_path, 'rb')
+            self.refresh()
+        else:
+            self._segment = open(self.segment_path, 'a+b')
+            self._index = open(self.index_path, 'a+b')
+            self._recover()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[position] for position in range(*key.indices(len(self)))]
+
+        with self._lock:
+            if key < 0:
+                key += len(self.offsets)
+            if not 0 <= key < len(self.offsets):
+                raise IndexError('block store index out of range')
+
+            block = self._cache.get(key)
+            if block is not None:
+                self._cache.move_to_end(key)
+                return block
+
+            block = json.loads(self._read(self.offsets[key]), object_hook=self.object_hook)
+            self._remember(key, block)
+            return block
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def append(self, block, block_hash):
+        """
+        Append a Block to the end of the store
+        :param block: Block
+        :param block_hash: <str> Hash of the Block
+        """
+        self.extend([block], [block_hash])
+
+    def extend(self, blocks, hashes):
+        """
+        Append Blocks to the end of the store
+        :param blocks: <list> Blocks
+        :param hashes: <list> Hash of every Block
+        """
+        with self._lock:
+            self._segment.seek(0, os.SEEK_END)
+            offset = self._segment.tell()
+
+            records = []
+            entries = []
+            offsets = []
+            for block, block_hash in zip(blocks, hashes):
+                payload = json.dumps(block, sort_keys=True, default=self.default).encode()
+                records.append(self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+                records.append(payload)
+                entries.append(self.INDEX_ENTRY.pack(offset, bytes.fromhex(block_hash)))
+                offsets.append(offset)
+                offset += self.RECORD_HEADER.size + len(payload)
+
+            # The records go to disk before their index entries, so an index
+            # entry never points at a record that was not written
+            self._segment.write(b''.join(records))
+            self._flush(self._segment)
+            self._index.write(b''.join(entries))
+            self._flush(self._index)
+
+            for block, block_hash, offset in zip(blocks, hashes, offsets):
+                self._remember(len(self.offsets), block)
+                self.offsets.append(offset)
+                self.hashes.append(block_hash)
+
+    def truncate(self, length):
+        """
+        Drop every block after the first length blocks
+        :param length: <int> Number of blocks to keep
+        """
+        with self._lock:
+            if length >= len(self.offsets):
+                return
+
+            self._close_map()
+            self._segment.truncate(self.offsets[length])
+            self._flush(self._segment)
+            self._index.truncate(length * self.INDEX_ENTRY.size)
+            self._flush(self._index)
+
+            del self.offsets[length:]
+            del self.hashes[length:]
+            for position in [position for position in self._cache if position >= length]:
+                del self._cache[position]
+
+    def refresh(self):
+        """
+        Catch up with the writer of a store opened readonly
+        :return: <int> Number of leading blocks that did not change
+        """
+        with self._lock:
+            whole_entries = os.fstat(self._index.fileno()).st_size // self.INDEX_ENTRY.size
+            unchanged = min(len(self.offsets), whole_entries)
+
+            # A truncate followed by new blocks rewrites entries we already
+            # read, which shows in the last of them we still have
+            if unchanged and self._index_entry(unchanged - 1) != (self.offsets[unchanged - 1], self.hashes[unchanged - 1]):
+                self._index.seek(0)
+                entries = self.INDEX_ENTRY.iter_unpack(self._index.read(whole_entries * self.INDEX_ENTRY.size))
+                unchanged = 0
+                for (offset, raw_hash), known_offset, known_hash in zip(entries, self.offsets, self.hashes):
+                    if offset != known_offset or raw_hash.hex() != known_hash:
+                        break
+                    unchanged += 1
+
+            del self.offsets[unchanged:]
+            del self.hashes[unchanged:]
+            for position in [position for position in self._cache if position >= unchanged]:
+                del self._cache[position]
+
+            self._index.seek(unchanged * self.INDEX_ENTRY.size)
+            for offset, raw_hash in self.INDEX_ENTRY.iter_unpack(self._index.read((whole_entries - unchanged) * self.INDEX_ENTRY.size)):
+                self.offsets.append(offset)
+                self.hashes.append(raw_hash.hex())
+            return unchanged
+
+    def _index_entry(self, position):
+        self._index.seek(position * self.INDEX_ENTRY.size)
+        offset, raw_hash = self.INDEX_ENTRY.unpack(self._index.read(self.INDEX_ENTRY.size))
+        return offset, raw_hash.hex()
+
+    def close(self):
+        with self._lock:
+            self._close_map()
+            self._segment.close()
+            self._index.close()
+
+    def _recover(self):
+        """
+        Load the index and repair the tail of the store after a crash: index
+        entries for records that were not fully written are dropped, complete
+        records that never got their index entry are indexed again and any
+        partial record at the end of blocks.dat is cut off.
+        """
+        self._index.seek(0)
+        index = self._index.read()
+        whole_entries = len(index) // self.INDEX_ENTRY.size
+        for offset, raw_hash in self.INDEX_ENTRY.iter_unpack(index[:whole_entries * self.INDEX_ENTRY.size]):
+            self.offsets.append(offset)
+            self.hashes.append(raw_hash.hex())
+
+        self._segment.seek(0, os.SEEK_END)
+        segment_size = self._segment.tell()
+
+        # Drop entries from the end until the last one points at a whole record
+        while self.offsets and self._record_end(self.offsets[-1], segment_size) is None:
+            self.offsets.pop()
+            self.hashes.pop()
+
+        end = self._record_end(self.offsets[-1], segment_size) if self.offsets else 0
+        missing = []
+        while True:
+            record_end = self._record_end(end, segment_size)
+            if record_end is None:
+                break
+            block = json.loads(self._read_at(end), object_hook=self.object_hook)
+            missing.append((end, self.hash_block(block)))
+            end = record_end
+
+        self._segment.truncate(end)
+        self._index.truncate(len(self.offsets) * self.INDEX_ENTRY.size)
+        self._index.seek(0, os.SEEK_END)
+        for offset, block_hash in missing:
+            self._index.write(self.INDEX_ENTRY.pack(offset, bytes.fromhex(block_hash)))
+            self.offsets.append(offset)
+            self.hashes.append(block_hash)
+        self._flush(self._segment)
+        self._flush(self._index)
+
+    def _record_end(self, offset, segment_size):
+        """
+        Offset just past the record at offset, or None if it is not whole and intact
+        """
+        header_end = offset + self.RECORD_HEADER.size
+        if header_end > segment_size:
+            return None
+
+        self._segment.seek(offset)
+        length, checksum = self.RECORD_HEADER.unpack(self._segment.read(self.RECORD_HEADER.size))
+        if header_end + length > segment_size:
+            return None
+        if zlib.crc32(self._segment.read(length)) != checksum:
+            return None
+        return header_end + length
+
+    def _read_at(self, offset):
+        """
+        Payload of the record at offset, read with plain file reads
+        """
+        self._segment.seek(offset)
+        length, _ = self.RECORD_HEADER.unpack(self._segment.read(self.RECORD_HEADER.size))
+        return self._segment.read(length)
+
+    def _read(self, offset):
+        """
+        Payload of the record at offset, read through the memory map, or
+        with plain reads for a readonly store
+        """
+        if self.readonly:
+            header = os.pread(self._segment.fileno(), self.RECORD_HEADER.size, offset)
+            length, _ = self.RECORD_HEADER.unpack(header)
+            return os.pread(self._segment.fileno(), length, offset + self.RECORD_HEADER.size)
+
+        header_end = offset + self.RECORD_HEADER.size
+        if self._map is None or header_end > len(self._map):
+            self._remap()
+        length, _ = self.RECORD_HEADER.unpack_from(self._map, offset)
+        if header_end + length > len(self._map):
+            self._remap()
+        return self._map[header_end:header_end + length]
+
+    def _remap(self):
+        # The file only grows between truncates, so map it again to see new records
+        self._close_map()
+        self._map = mmap.mmap(self._segment.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _remember(self, position, block):
+        self._cache[position] = block
+        self._cache.move_to_end(position)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _flush(self, file):
+        file.flush()
+        if self.sync:
+            os.fsync(file.fileno())
@@ -0,0 +1,210 @@
+import struct
+
+
+class Codec:
+    """
+    Compact, deterministic binary encoding for blocks and transactions.
+
+    Every value is a one byte tag followed by its payload. Integers and
+    lengths are unsigned LEB128 varints, floats are 8 byte IEEE 754 doubles,
+    and strings are UTF-8. Maps are written with their keys in sorted order, so
+    equal values always encode to the same bytes and the encoding can be
+    hashed. A transaction record is written as its type name and then its field
+    values in schema order. The field names are not repeated for every
+    transaction.
+    """
+
+    MIMETYPE = 'application/x-blockchain-codec'
+
+    NONE = ord('N')
+    TRUE = ord('T')
+    FALSE = ord('F')
+    INT = ord('i')
+    NEGATIVE_INT = ord('n')
+    FLOAT = ord('d')
+    STR = ord('s')
+    BYTES = ord('b')
+    LIST = ord('l')
+    MAP = ord('m')
+    RECORD = ord('r')
+
+    DOUBLE = struct.Struct('>d')
+
+    def __init__(self, record_types=None):
+        """
+        :param record_types: <dict> type name -> record class, read on every
+                             call so types registered later are known too.
+                             Record classes have type and fields attributes
+                             and one attribute per field.
+        """
+        self.record_types = record_types if record_types is not None else {}
+
+    def encode(self, value):
+        """
+        :return: <bytes> the encoding of value
+        :raises TypeError: for values it cannot encode
+        """
+        out = []
+        self._encode(value, out)
+        return b''.join(out)
+
+    def decode(self, data, object_hook=None):
+        """
+        :param data: <bytes> an encoding made by encode
+        :param object_hook: <callable> called with every decoded map, like json.loads's
+        :return: the decoded value
+        :raises ValueError: if data is not a valid encoding
+        """
+        try:
+            value, position = self._decode(bytes(data), 0, object_hook)
+        except (IndexError, struct.error, UnicodeDecodeError) as e:
+            raise ValueError(f'Invalid encoding: {e}') from None
+        if position != len(data):
+            raise ValueError('Invalid encoding: trailing bytes')
+        return value
+
+    @staticmethod
+    def varint(number):
+        if number < 0x80:
+            return _SMALL[number]
+        out = bytearray()
+        while number >= 0x80:
+            out.append(number & 0x7f | 0x80)
+            number >>= 7
+        out.append(number)
+        return bytes(out)
+
+    def _encode(self, value, out):
+        # Checked in order of how common they are in blocks, this runs for every value
+        kind = type(value)
+        if kind is str:
+            encoded = value.encode()
+            length = len(encoded)
+            out.append(_STR_HEADERS[length] if length < 0x80 else b's' + self.varint(length))
+            out.append(encoded)
+        elif kind is int:
+            if 0 <= value < 0x80:
+                out.append(_INT_HEADERS[value])
+            elif value >= 0:
+                out.append(b'i' + self.varint(value))
+            else:
+                out.append(b'n' + self.varint(-value))
+        elif kind is dict:
+            out.append(b'm' + self.varint(len(value)))
+            for key in sorted(value):
+                if type(key) is not str:
+                    raise TypeError(f'Map keys must be strings, not {key.__class__.__name__}')
+                encoded = key.encode()
+                out.append(self.varint(len(encoded)))
+                out.append(encoded)
+                self._encode(value[key], out)
+        elif kind is list or kind is tuple:
+            out.append(b'l' + self.varint(len(value)))
+            for item in value:
+                self._encode(item, out)
+        elif kind is float:
+            out.append(b'd' + self.DOUBLE.pack(value))
+        elif value is None:
+            out.append(b'N')
+        elif kind is bool:
+            out.append(b'T' if value else b'F')
+        elif kind is bytes:
+            out.append(b'b' + self.varint(len(value)))
+            out.append(value)
+        elif self.record_types.get(getattr(value, 'type', None)) is kind:
+            name = value.type.encode()
+            out.append(b'r' + self.varint(len(name)))
+            out.append(name)
+            for field in value.fields:
+                self._encode(getattr(value, field), out)
+        else:
+            raise TypeError(f'Object of type {kind.__name__} cannot be encoded')
+
+    @staticmethod
+    def _read_varint(data, position):
+        number = 0
+        shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            number |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return number, position
+            shift += 7
+
+    def _read_str(self, data, position):
+        length = data[position]
+        if length < 0x80:
+            position += 1
+        else:
+            length, position = self._read_varint(data, position)
+        end = position + length
+        if end > len(data):
+            raise IndexError('string runs past the end')
+        return data[position:end].decode(), end
+
+    def _decode(self, data, position, object_hook):
+        tag = data[position]
+        position += 1
+
+        if tag == self.STR:
+            return self._read_str(data, position)
+        if tag == self.INT:
+            if data[position] < 0x80:
+                return data[position], position + 1
+            return self._read_varint(data, position)
+        if tag == self.RECORD:
+            name, position = self._read_str(data, position)
+            record = self.record_types.get(name)
+            if record is None:
+                raise ValueError(f'Invalid encoding: unknown record type {name!r}')
+            # Setting the fields on a bare instance is cheaper than a keyword call per record
+            instance = record.__new__(record)
+            for field in record.fields:
+                # Most fields are short strings, read those without the call
+                length = data[position + 1]
+                if data[position] == self.STR and length < 0x80 and position + 2 + length <= len(data):
+                    position += 2 + length
+                    value = data[position - length:position].decode()
+                else:
+                    value, position = self._decode(data, position, object_hook)
+                setattr(instance, field, value)
+            return instance, position
+        if tag == self.MAP:
+            count, position = self._read_varint(data, position)
+            values = {}
+            for _ in range(count):
+                key, position = self._read_str(data, position)
+                values[key], position = self._decode(data, position, object_hook)
+            return (object_hook(values) if object_hook is not None else values), position
+        if tag == self.LIST:
+            count, position = self._read_varint(data, position)
+            items = []
+            for _ in range(count):
+                item, position = self._decode(data, position, object_hook)
+                items.append(item)
+            return items, position
+        if tag == self.FLOAT:
+            return self.DOUBLE.unpack_from(data, position)[0], position + self.DOUBLE.size
+        if tag == self.NEGATIVE_INT:
+            number, position = self._read_varint(data, position)
+            return -number, position
+        if tag == self.BYTES:
+            length, position = self._read_varint(data, position)
+            end = position + length
+            if end > len(data):
+                raise IndexError('bytes run past the end')
+            return data[position:end], end
+        if tag == self.NONE:
+            return None, position
+        if tag == self.TRUE:
+            return True, position
+        if tag == self.FALSE:
+            return False, position
+        raise ValueError(f'Invalid encoding: unknown tag {tag!r}')
+
+
+# Encodings of the one byte varints, and of the tag and length of short strings and small ints
+_SMALL = [bytes((number,)) for number in range(0x80)]
+_STR_HEADERS = [b's' + small for small in _SMALL]
+_INT_HEADERS = [b'i' + small for small in _SMALL]
@@ -0,0 +1,268 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A metric family: one series per combination of label values.
+    Series are created up front with labels() or on first use, after that
+    updating one only takes its own small lock. Metrics without labels have
+    a single series, updated through the family itself.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._series[()] = self._new_series()
+
+    def labels(self, *values):
+        """
+        The series for a set of label values, created the first time it is asked for
+        """
+        series = self._series.get(values)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(values, self._new_series())
+        return series
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Drop every series, to count again from zero
+        """
+        with self._lock:
+            self._series = {}
+            if not self.labelnames:
+                self._series[()] = self._new_series()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for values, series in list(self._series.items()):
+            lines.extend(series.render(self.name, self.labelnames, values))
+        return lines
+
+
+class _CounterSeries:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, labelnames, values):
+        return [f'{name}{_format_labels(labelnames, values)} {_format_value(self.value)}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_series(self):
+        return _CounterSeries()
+
+    def inc(self, amount=1):
+        self._series[()].inc(amount)
+
+
+class _GaugeSeries:
+    def __init__(self, callback=None):
+        self.value = 0
+        self.callback = callback
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, labelnames, values):
+        value = self.callback() if self.callback is not None else self.value
+        return [f'{name}{_format_labels(labelnames, values)} {_format_value(value)}']
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. With a callback it is read when the
+    metrics are rendered, so nothing has to update it.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        self.callback = callback
+        super().__init__(name, documentation, labelnames)
+
+    def _new_series(self):
+        return _GaugeSeries(self.callback)
+
+    def set(self, value):
+        self._series[()].set(value)
+
+
+class _HistogramSeries:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[position] += 1
+            self.sum += value
+
+    @contextmanager
+    def timer(self):
+        """
+        Observe how many seconds the with block took
+        """
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started)
+
+    def render(self, name, labelnames, values):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [float('inf')], counts):
+            cumulative += count
+            labels = _format_labels(labelnames, values, [('le', _format_value(float(bound)))])
+            lines.append(f'{name}_bucket{labels} {cumulative}')
+        labels = _format_labels(labelnames, values)
+        lines.append(f'{name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{name}_count{labels} {cumulative}')
+        return lines
+
+
+class Histogram(Metric):
+    """
+    Observations counted into fixed buckets, allocated once per series
+    """
+
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_series(self):
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value):
+        self._series[()].observe(value)
+
+    def timer(self):
+        return self._series[()].timer()
+
+
+class Registry:
+    """
+    The metrics a node exposes, rendered in the Prometheus text format
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _parse_value(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def merge(texts):
+    """
+    Add up registries rendered in the Prometheus text format, like the same
+    Registry in several processes. Counters and histograms are summed,
+    gauges are taken from the first text that has them.
+    :param texts: <list> of <str> rendered by Registry.render
+    :return: <str> in the same format
+    """
+    #family name -> its HELP and TYPE lines, its type and its samples
+    families = {}
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split(' ', 3)[2]
+                family = families.setdefault(name, {'header': [], 'type': None, 'samples': {}})
+                if not family['header']:
+                    family['header'].append(line)
+            elif line.startswith('# TYPE '):
+                kind = line.split(' ', 3)[3]
+                if family['type'] is None:
+                    family['type'] = kind
+                    family['header'].append(line)
+            elif line and family is not None:
+                series, value = line.rsplit(' ', 1)
+                value = _parse_value(value)
+                samples = family['samples']
+                if series not in samples:
+                    samples[series] = value
+                elif family['type'] in ('counter', 'histogram'):
+                    samples[series] += value
+
+    lines = []
+    for family in families.values():
+        lines.extend(family['header'])
+        lines.extend(f'{series} {_format_value(value)}' for series, value in family['samples'].items())
+    return '\n'.join(lines) + '\n'
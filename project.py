@@ -1,25 +1,844 @@
+import atexit
+import gzip
 import hashlib
+import heapq
+import itertools
 import json
-from time import time
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from datetime import datetime
+from time import perf_counter, sleep, time
 from urllib.parse import urlparse
 from uuid import uuid4
 
 import requests
-from flask import Flask, jsonify, request
+from blockstore import BlockStore
+from codec import Codec
+from flask import Flask, Response, g, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.serving import make_server
+from metrics import Registry, merge
+from tieredchain import TieredChain
+
+# Leading hex zeroes the hash of a valid proof must start with
+DIFFICULTY = 4
+
+# Version of the Blocks we create. Version 1 Blocks are hashed as JSON,
+# version 2 Blocks and their transactions in the binary Codec encoding.
+BLOCK_VERSION = 2
+
+# Responses smaller than this are not worth compressing
+COMPRESSION_MIN_SIZE = 1024
+
+# Number of nonces a mining worker searches per task
+MINING_CHUNK_SIZE = 2 ** 14
+
+# How many nonces are tested between checks on whether another worker already won
+MINING_BATCH_SIZE = 1024
+
+# Chains with fewer blocks to check than this are validated on a single core
+PARALLEL_VALIDATION_MIN_BLOCKS = 1024
+
+# Seconds to wait for one peer, and for all peers in a consensus round
+PEER_TIMEOUT = 5
+CONSENSUS_TIMEOUT = 15
+
+# Seconds between the writes of a worker process's metrics, which the
+# process that owns the chain adds to its own on /metrics
+WORKER_METRICS_INTERVAL = 1
+
+# Peers fetched at the same time during consensus
+PEER_FETCH_WORKERS = 16
+
+# What a dead, slow or broken peer makes a fetch raise
+PEER_ERRORS = (requests.RequestException, ValueError, KeyError, TypeError)
+
+# Peers a new block or transaction is pushed to, and how many hashes of
+# blocks and transactions already seen are remembered to drop repeats
+GOSSIP_FANOUT = 8
+GOSSIP_SEEN_SIZE = 100000
+
+# Threads gossip is pushed on, apart from the consensus fetches, and pushes
+# that may wait for one before new ones are dropped
+GOSSIP_WORKERS = 4
+GOSSIP_QUEUE_SIZE = 1000
+
+# Transactions announced one at a time are gathered for this many seconds,
+# or until there are this many, and pushed to peers together
+GOSSIP_BATCH_WAIT = 0.05
+GOSSIP_BATCH_SIZE = 500
+
+# Committed transactions and client idempotency keys remembered to turn
+# retried submissions away
+DUPLICATE_WINDOW = 100000
+
+# Side branches whose tip falls this many Blocks behind our best tip are dropped
+SIDE_BRANCH_DEPTH = 100
+
+# Tips of our other branches we ask a peer to continue from before searching
+# back along our chain for a block it knows
+SIDE_TIPS_TRIED = 4
+
+# Shared lowest proof found so far, set in every worker by _init_mining_worker
+_found_proof = None
+
+# Metrics served on /metrics. They are updated once per proof, block, chain
+# check or request, never inside the nonce loop.
+registry = Registry()
+HASHES = registry.counter('blockchain_hashes_total', 'Nonces hashed by proof of work')
+HASH_RATE = registry.gauge('blockchain_hash_rate', 'Hashes per second of the last proof of work')
+PROOF_OF_WORK_SECONDS = registry.histogram('blockchain_proof_of_work_seconds', 'Time to find a proof')
+BLOCKS_MINED = registry.counter('blockchain_blocks_mined_total', 'Blocks forged by the miner', ('route',))
+MEMPOOL_DEPTH = registry.gauge('blockchain_mempool_depth', 'Transactions waiting to be sealed', callback=lambda: len(blockchain.mempool))
+CHAIN_LENGTH = registry.gauge('blockchain_chain_length', 'Blocks in the chain', callback=lambda: len(blockchain.chain))
+VALID_CHAIN_SECONDS = registry.histogram('blockchain_valid_chain_seconds', 'Time to check a run of blocks')
+PEER_FETCH_SECONDS = registry.histogram('blockchain_peer_fetch_seconds', 'Time to fetch blocks from a peer during consensus', ('peer',))
+PEER_FETCH_FAILURES = registry.counter('blockchain_peer_fetch_failures_total', 'Peers that failed or timed out during consensus', ('peer',))
+GOSSIP_RECEIVED = registry.counter('blockchain_gossip_received_total', 'Blocks and transactions pushed by peers', ('kind', 'result'))
+GOSSIP_DROPPED = registry.counter('blockchain_gossip_dropped_total', 'Pushes to peers dropped because too many were waiting to be sent')
+REQUEST_SECONDS = registry.histogram('http_request_duration_seconds', 'Time to handle a request', ('route',))
+REQUEST_BYTES = registry.counter('http_request_bytes_total', 'Bytes of request bodies received', ('route',))
+RESPONSE_BYTES = registry.counter('http_response_bytes_total', 'Bytes of response bodies sent, streamed bodies are not counted', ('route',))
+_fetch_failures_lock = threading.Lock()
+
+
+def count_fetch_failure(node, counted=None):
+    """
+    Count a peer that failed or timed out
+    :param node: Address of node. Eg. '192.168.0.5:5000'
+    :param counted: <set> Peers already counted this consensus round, a
+                    peer that times out and then fails is only counted once
+    """
+    if counted is not None:
+        with _fetch_failures_lock:
+            if node in counted:
+                return
+            counted.add(node)
+    PEER_FETCH_FAILURES.labels(node).inc()
+
+
+def block_work():
+    """
+    Expected number of hashes it takes to mine a Block. Every Block is mined
+    at DIFFICULTY, so every Block adds the same work to its chain.
+    """
+    return 16 ** DIFFICULTY
+
+
+def meets_difficulty(digest):
+    """
+    Check a raw SHA-256 digest against DIFFICULTY without building the hexdigest
+    :param digest: <bytes>
+    :return: <bool>
+    """
+    zero_bytes, half_byte = divmod(DIFFICULTY, 2)
+    if digest[:zero_bytes] != bytes(zero_bytes):
+        return False
+    return not half_byte or digest[zero_bytes] < 0x10
+
+
+def search_proof(last_proof, last_hash, start, stop):
+    """
+    Find the lowest valid proof in [start, stop).
+    Gives the same answer as calling valid_proof on every nonce in turn, but
+    hashes the constant last_proof prefix once, feeds the nonce and last_hash
+    into a copy of that state and compares raw digest bytes.
+
+    :param last_proof: <int> Previous Proof
+    :param last_hash: <str> The hash of the Previous Block
+    :param start: <int> first nonce to try
+    :param stop: <int> first nonce not to try
+    :return: <int> or None
+    """
+    prefix = hashlib.sha256(f'{last_proof}'.encode())
+    suffix = last_hash.encode()
+    copy = prefix.copy
+    zero_bytes, half_byte = divmod(DIFFICULTY, 2)
+    target = bytes(zero_bytes)
+
+    for proof in range(start, stop):
+        guess = copy()
+        guess.update(b'%d' % proof)
+        guess.update(suffix)
+        digest = guess.digest()
+        if digest[:zero_bytes] == target and (not half_byte or digest[zero_bytes] < 0x10):
+            return proof
+
+    return None
+
+
+def _init_mining_worker(found_proof):
+    global _found_proof
+    _found_proof = found_proof
+
+
+def _use_difficulty(difficulty):
+    # Workers started with spawn or forkserver import this module afresh and
+    # do not see a DIFFICULTY the parent set after importing it, so every
+    # task carries the one it is checked at
+    global DIFFICULTY
+    DIFFICULTY = difficulty
+
+
+def _search_proof(task):
+    """
+    Search one chunk of the nonce space for a valid proof
+    :param task: <tuple> (last_proof, last_hash, start, stop, difficulty)
+    :return: <int> lowest valid proof in [start, stop) or None
+    """
+    last_proof, last_hash, start, stop, difficulty = task
+    _use_difficulty(difficulty)
+
+    for batch_start in range(start, stop, MINING_BATCH_SIZE):
+        # Give up once a lower proof was found, only chunks below it still matter
+        if _found_proof.value < start:
+            return None
+
+        proof = search_proof(last_proof, last_hash, batch_start, min(batch_start + MINING_BATCH_SIZE, stop))
+        if proof is not None:
+            with _found_proof.get_lock():
+                if proof < _found_proof.value:
+                    _found_proof.value = proof
+            return proof
+
+    return None
+
+
+class Transaction:
+    """
+    A transaction record. Every type in the schema registry gets a subclass
+    with one slot per field, which takes far less memory than a dict with
+    the same keys. Records read like dicts and are turned into one only for
+    hashing and the API, so Block hashes are the same as for plain dicts.
+    """
+
+    __slots__ = ()
+
+    #name of the transaction type and its fields, set on every subclass
+    type = None
+    fields = ()
+
+    def __init__(self, **values):
+        for field in self.fields:
+            setattr(self, field, values[field])
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Build a record from the fields of a dict, anything else in it is ignored
+        :param values: <dict>
+        :return: <Transaction>
+        """
+        return cls(**{field: values[field] for field in cls.fields})
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def keys(self):
+        return self.fields
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in self.fields else default
+
+    def __getitem__(self, field):
+        if field not in self.fields:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def __eq__(self, other):
+        if isinstance(other, (Transaction, dict)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    def __reduce__(self):
+        return self.__class__.from_dict, (self.to_dict(),)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.to_dict()!r})'
+
+
+#transaction type name -> record class
+TRANSACTION_TYPES = {}
+
+#set of field names -> record class, to recognise transactions that arrive as dicts
+_transaction_types_by_fields = {}
+
+
+def register_transaction_type(name, fields):
+    """
+    Define a transaction type once: its record class and the fields the
+    /transactions/new* routes require for it
+    :param name: <str> Name of the type, eg. 'desk'
+    :param fields: <tuple> Names of its fields
+    :return: <type> The record class
+    """
+    record = type(f'{name.title()}Transaction', (Transaction,), {
+        '__slots__': fields,
+        'type': name,
+        'fields': fields,
+    })
+    TRANSACTION_TYPES[name] = record
+    _transaction_types_by_fields[frozenset(fields)] = record
+    return record
+
+
+def record_from_dict(values):
+    """
+    Turn a dict with exactly the fields of a transaction type into its
+    record, used as a JSON object_hook. Anything else is returned as it is.
+    :param values: <dict>
+    :return: <Transaction> or <dict>
+    """
+    record = _transaction_types_by_fields.get(frozenset(values))
+    if record is None:
+        return values
+    return record(**values)
+
+
+def transaction_type(transaction):
+    """
+    Name of the type of a transaction, also for one that arrived as a dict
+    :param transaction: <Transaction> or <dict>
+    :return: <str> or None if it is of no known type
+    """
+    if not isinstance(transaction, Transaction):
+        transaction = _transaction_types_by_fields.get(frozenset(transaction))
+    return getattr(transaction, 'type', None)
+
+
+def json_default(value):
+    """
+    JSON encoder hook that writes transaction records as dicts
+    """
+    if isinstance(value, Transaction):
+        return value.to_dict()
+    raise TypeError(f'Object of type {value.__class__.__name__} is not JSON serializable')
+
+
+DeskTransaction = register_transaction_type('desk', (
+    'PatientID', 'PatientName', 'PatientSurname', 'CovidStatus', 'Temperature', 'DateofCertificate',
+))
+AdmissionTransaction = register_transaction_type('admission', (
+    'PatientID', 'NextofKin', 'Gender', 'Age', 'DOB', 'IDNumber', 'MaritalStatus', 'EmailAddress',
+    'MedicalAid', 'MedicalAidNumber', 'ConsultationFee', 'TestsFee',
+))
+AssessmentTransaction = register_transaction_type('assessment', (
+    'PatientID', 'Notes', 'Allergies', 'Symptoms', 'BP', 'Pulse', 'Temperature', 'Respirations',
+    'Oxygen', 'Weight', 'Height', 'PriorityLevel',
+))
+DoctorTransaction = register_transaction_type('doctor', (
+    'PatientID', 'LabNotes', 'Diagnosis', 'Prescription', 'recommendation',
+))
+LabTransaction = register_transaction_type('lab', (
+    'PatientID', 'BloodTest', 'Xray', 'UltraSound', 'Cultures', 'Lipid', 'Hemoglobin', 'urinanalysis', 'other',
+))
+DispensaryTransaction = register_transaction_type('dispensary', (
+    'PatientID', 'Medication',
+))
+
+
+#binary encoding of blocks and records for hashing and the wire
+codec = Codec(TRANSACTION_TYPES)
+
+
+# Fields of a Block that go into its hash once it carries a Merkle root
+BLOCK_HEADER_FIELDS = ('index', 'timestamp', 'proof', 'previous_hash', 'merkle_root')
+
+
+def block_header(block):
+    """
+    The fields of a Block with a Merkle root that its hash covers
+    :param block: Block
+    :return: <dict>
+    """
+    header = {field: block[field] for field in BLOCK_HEADER_FIELDS}
+    if 'version' in block:
+        header['version'] = block['version']
+    return header
+
+
+def transaction_hash(transaction, version=BLOCK_VERSION):
+    """
+    Merkle leaf hash of a transaction
+    :param transaction: <Transaction> or <dict>
+    :param version: <int> Version of the Block it is in
+    :return: <bytes>
+    """
+    if version < 2:
+        transaction_string = json.dumps(transaction, sort_keys=True, default=json_default).encode()
+        return hashlib.sha256(b'\x00' + transaction_string).digest()
+
+    # A dict with the fields of a transaction type hashes the same as its record
+    if isinstance(transaction, dict):
+        transaction = record_from_dict(transaction)
+    return hashlib.sha256(b'\x00' + codec.encode(transaction)).digest()
+
+
+def merkle_levels(transactions, version=BLOCK_VERSION, leaves=None):
+    """
+    Every level of the Merkle tree over transactions, leaves first.
+    Leaves and inner nodes are hashed with different prefixes, and a node
+    without a sibling moves up a level unchanged instead of being paired
+    with itself, so two different lists can not share a root.
+    :param transactions: <list>
+    :param version: <int> Version of the Block they are in
+    :param leaves: <list> transaction_hash of every transaction, if the caller has them already
+    :return: <list> of <list> of <bytes>
+    """
+    level = leaves if leaves is not None else [transaction_hash(transaction, version) for transaction in transactions]
+    levels = [level]
+    while len(level) > 1:
+        level = [
+            hashlib.sha256(b'\x01' + level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+        levels.append(level)
+    return levels
+
+
+def merkle_root(transactions, version=BLOCK_VERSION, leaves=None):
+    """
+    Merkle root of transactions
+    :param transactions: <list>
+    :param version: <int> Version of the Block they are in
+    :param leaves: <list> As for merkle_levels
+    :return: <str> hex digest, the hash of nothing for an empty list
+    """
+    if not transactions:
+        return hashlib.sha256(b'').hexdigest()
+    return merkle_levels(transactions, version, leaves)[-1][0].hex()
+
+
+def merkle_proof(transactions, position, version=BLOCK_VERSION):
+    """
+    The sibling hashes that lead from one transaction up to the Merkle root
+    :param transactions: <list>
+    :param position: <int> Position of the transaction in transactions
+    :param version: <int> Version of the Block they are in
+    :return: <list> of {'hash': <str>, 'side': 'left' or 'right'}
+    """
+    proof = []
+    for level in merkle_levels(transactions, version)[:-1]:
+        sibling = position ^ 1
+        if sibling < len(level):
+            proof.append({
+                'hash': level[sibling].hex(),
+                'side': 'left' if sibling < position else 'right',
+            })
+        position //= 2
+    return proof
+
+
+def verify_merkle_proof(transaction, proof, root, version=BLOCK_VERSION):
+    """
+    Check a Merkle proof with one hash per level of the tree
+    :param transaction: <Transaction> or <dict>
+    :param proof: <list> as returned by merkle_proof
+    :param root: <str> Merkle root of the Block
+    :param version: <int> Version of the Block
+    :return: <bool>
+    """
+    node = transaction_hash(transaction, version)
+    for step in proof:
+        sibling = bytes.fromhex(step['hash'])
+        if step['side'] == 'left':
+            node = hashlib.sha256(b'\x01' + sibling + node).digest()
+        else:
+            node = hashlib.sha256(b'\x01' + node + sibling).digest()
+    return node.hex() == root
+
+
+class MempoolFull(Exception):
+    """
+    Raised when the mempool has no room for more transactions
+    """
+
+    def __init__(self, retry_after):
+        super().__init__('Mempool is full')
+        self.retry_after = retry_after
+
+
+# Priority rank of PriorityLevel values on assessments, lower goes first.
+# Numbers and the triage colours are both understood.
+PRIORITY_LEVELS = {
+    '1': 0, 'red': 0, 'emergency': 0, 'immediate': 0,
+    '2': 1, 'orange': 1, 'very urgent': 1,
+    '3': 2, 'yellow': 2, 'urgent': 2,
+    '4': 3, 'green': 3, 'standard': 3,
+    '5': 4, 'blue': 4, 'non urgent': 4,
+}
+
+# Priority rank of each transaction type when it has no PriorityLevel of its own
+TRANSACTION_PRIORITIES = {
+    'assessment': 2,
+    'doctor': 2,
+    'lab': 2,
+    'dispensary': 3,
+    'admission': 3,
+    'desk': 4,
+}
+
+
+def transaction_priority(transaction):
+    """
+    Priority rank of a pending transaction, lower goes into a Block first
+    :param transaction: <Transaction>
+    :return: <int>
+    """
+    level = PRIORITY_LEVELS.get(str(transaction.get('PriorityLevel', '')).strip().lower())
+    if level is not None:
+        return level
+    return TRANSACTION_PRIORITIES.get(getattr(transaction, 'type', None), max(TRANSACTION_PRIORITIES.values()))
+
+
+class Mempool:
+    """
+    Transactions waiting to go into the next Block, handed out by priority.
+
+    Transactions are kept in a heap ordered by the rank priority() gives them
+    and by arrival, and new Blocks are sealed from the top of it. Every
+    aging seconds a transaction has waited counts as one rank better, so a
+    burst of urgent records can hold back routine ones but never forever.
+    As every transaction ages at the same rate, that order does not change
+    over time and is fixed when the transaction arrives.
+
+    Request threads add to it while the miner takes from it, so both happen
+    under a lock. It holds at most capacity transactions, past that adding
+    raises MempoolFull so clients can be told to back off.
+    """
+
+    def __init__(self, capacity=100000, retry_after=5, priority=transaction_priority, aging=30):
+        """
+        :param capacity: <int> Most transactions held at once
+        :param retry_after: <int> Seconds clients are asked to wait when it is full
+        :param priority: <callable> Rank of a transaction, lower goes first
+        :param aging: <float> Seconds of waiting worth one rank
+        """
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.priority = priority
+        self.aging = aging
+
+        #heap of (key, sequence number, arrival time, rank, transaction, hash)
+        self._heap = []
+        #the same entries in arrival order, taken ones are dropped lazily
+        self._arrivals = deque()
+        self._taken = set()
+        #transaction hash -> sequence numbers of the pending entries with it,
+        #more than one when clients sent identical records under different keys
+        self._hashes = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+        self.added = 0
+        self.taken = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.last_mean_wait = 0.0
+        self.last_max_wait = 0.0
+        self.waits_by_rank = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, transaction, force=False):
+        """
+        Add a transaction
+        :param transaction: <Transaction>
+        :param force: <bool> Add it even when the mempool is full, and ahead of
+                      everything else. Used for the miner's own reward.
+        :raises MempoolFull: if there is no room for it
+        """
+        self.add_many([transaction], force)
+
+    def add_many(self, transactions, force=False, hashes=None):
+        """
+        Add all of the transactions, or none of them if they do not fit
+        :param transactions: <list> of <Transaction>
+        :param force: <bool> As for add
+        :param hashes: <list> transaction_hash of each, if the caller has them already
+        :raises MempoolFull: if there is no room for all of them
+        """
+        now = time()
+        if force:
+            ranks = [None] * len(transactions)
+        else:
+            ranks = [self.priority(transaction) for transaction in transactions]
+        if hashes is None:
+            hashes = [transaction_hash(transaction) for transaction in transactions]
+
+        with self._lock:
+            if not force and len(self._heap) + len(transactions) > self.capacity:
+                self.rejected += len(transactions)
+                raise MempoolFull(self.retry_after)
+
+            for transaction, rank, digest in zip(transactions, ranks, hashes):
+                key = float('-inf') if rank is None else rank + now / self.aging
+                entry = (key, next(self._sequence), now, rank, transaction, digest)
+                heapq.heappush(self._heap, entry)
+                self._arrivals.append(entry)
+                self._hashes.setdefault(digest, []).append(entry[1])
+            self.added += len(transactions)
+
+    def discard(self, hashes):
+        """
+        Drop pending transactions that went into a Block from somewhere else,
+        one pending copy for every time a hash is given
+        :param hashes: <iterable> transaction_hash of each
+        """
+        with self._lock:
+            dropped = set()
+            for digest in hashes:
+                sequences = self._hashes.get(digest)
+                if sequences:
+                    dropped.add(sequences.pop(0))
+                    if not sequences:
+                        del self._hashes[digest]
+            if not dropped:
+                return
+
+            self._heap = [entry for entry in self._heap if entry[1] not in dropped]
+            heapq.heapify(self._heap)
+            self._taken.update(dropped)
+
+    def __contains__(self, digest):
+        return digest in self._hashes
+
+    def take(self, limit=None):
+        """
+        Take the most pressing pending transactions out for a new Block
+        :param limit: <int> Most transactions to take, all of them if None
+        :return: <list> of <Transaction> in priority order
+        """
+        now = time()
+        with self._lock:
+            if limit is None or limit >= len(self._heap):
+                entries = sorted(self._heap)
+                self._heap = []
+                self._arrivals.clear()
+                self._taken.clear()
+                self._hashes.clear()
+            else:
+                entries = [heapq.heappop(self._heap) for _ in range(limit)]
+                self._taken.update(entry[1] for entry in entries)
+                for entry in entries:
+                    sequences = self._hashes[entry[5]]
+                    sequences.remove(entry[1])
+                    if not sequences:
+                        del self._hashes[entry[5]]
+
+            if entries:
+                waits = [now - entry[2] for entry in entries]
+                self.taken += len(entries)
+                self.total_wait += sum(waits)
+                self.last_mean_wait = sum(waits) / len(waits)
+                self.last_max_wait = max(waits)
+                for entry, wait in zip(entries, waits):
+                    count, total = self.waits_by_rank.get(entry[3], (0, 0.0))
+                    self.waits_by_rank[entry[3]] = (count + 1, total + wait)
+
+        return [entry[4] for entry in entries]
+
+    def pending(self):
+        """
+        A copy of the pending transactions
+        :return: <list> of <Transaction> in arrival order
+        """
+        with self._lock:
+            return [entry[4] for entry in self._arrivals if entry[1] not in self._taken]
+
+    def oldest_wait(self):
+        """
+        Seconds the oldest pending transaction has been waiting
+        :return: <float>
+        """
+        with self._lock:
+            while self._arrivals and self._arrivals[0][1] in self._taken:
+                self._taken.discard(self._arrivals.popleft()[1])
+            if not self._arrivals:
+                return 0.0
+            return time() - self._arrivals[0][2]
+
+    def stats(self):
+        return {
+            'depth': len(self._heap),
+            'capacity': self.capacity,
+            'added': self.added,
+            'taken': self.taken,
+            'rejected': self.rejected,
+            'oldest_wait': self.oldest_wait(),
+            'mean_wait': self.total_wait / self.taken if self.taken else 0.0,
+            'mean_wait_by_priority': {
+                'reward' if rank is None else str(rank): total / count
+                for rank, (count, total) in self.waits_by_rank.items()
+            },
+            'last_block_mean_wait': self.last_mean_wait,
+            'last_block_max_wait': self.last_max_wait,
+        }
+
+
+class RecentTransactions:
+    """
+    Where recently committed transactions went, and the idempotency keys
+    clients sent with recent submissions, so a retried request is answered
+    with the copy we already have instead of adding another.
+
+    Both are kept in insertion order and hold at most window entries, past
+    that the oldest are forgotten. Lookups are dict lookups.
+    """
+
+    def __init__(self, window=DUPLICATE_WINDOW):
+        """
+        :param window: <int> Most transaction hashes, and most keys, remembered
+        """
+        self.window = window
+
+        #transaction hash -> index of the Block that holds it
+        self._blocks = OrderedDict()
+        #idempotency key -> hash of the transaction sent with it
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def commit(self, index, hashes):
+        """
+        Remember the transactions of a Block
+        :param index: <int> Index of the Block
+        :param hashes: <iterable> Hash of every transaction in it
+        """
+        with self._lock:
+            for digest in hashes:
+                self._blocks[digest] = index
+                self._blocks.move_to_end(digest)
+            while len(self._blocks) > self.window:
+                self._blocks.popitem(last=False)
+
+    def uncommit(self, hashes):
+        """
+        Forget transactions whose Block left our chain
+        :param hashes: <iterable> Hash of every transaction in it
+        """
+        with self._lock:
+            for digest in hashes:
+                self._blocks.pop(digest, None)
+
+    def block_of(self, digest):
+        """
+        :return: <int> Index of the recent Block holding a transaction, or None
+        """
+        return self._blocks.get(digest)
+
+    def remember_key(self, key, digest):
+        with self._lock:
+            self._keys[key] = digest
+            while len(self._keys) > self.window:
+                self._keys.popitem(last=False)
+
+    def key_hash(self, key):
+        """
+        :return: <bytes> Hash of the transaction sent with an idempotency key, or None
+        """
+        return self._keys.get(key)
+
+
+def _validate_segment(task):
+    """
+    Check the hash links and proofs of a run of blocks on a validation worker
+    :param task: <tuple> (previous_block, previous_hash, blocks, difficulty),
+                 previous_hash is computed here when None
+    :return: <list> hash of every block in blocks, or None if the run is invalid
+    """
+    previous_block, previous_hash, blocks, difficulty = task
+    _use_difficulty(difficulty)
+    if previous_hash is None:
+        previous_hash = Blockchain.hash(previous_block)
+    return Blockchain.check_blocks(previous_block, previous_hash, blocks)
+
 
 class Blockchain:
-    def __init__(self):
-        self.current_transactions = []
+    def __init__(self, mining_workers=1):
+        self.mempool = Mempool()
         self.chain =[]
         self.nodes = set()
 
+        #hash of every block in the chain, computed once when the block is added
+        self.hashes = []
+        self.block_positions = {}
+
+        #every valid block we know of forms a tree: work is the cumulative work
+        #up to each block by hash, side_blocks holds the blocks that are not
+        #in our chain and tips the blocks no known block builds on
+        self.work = {}
+        self.side_blocks = {}
+        self.tips = set()
+
+        #most transactions sealed into one Block, None for no limit
+        self.max_block_size = None
+
+        #on-disk BlockStore holding the chain, None keeps it in memory only
+        self.store = None
+
+        #where recently committed transactions went, to turn duplicates away
+        self.recent = RecentTransactions()
+
+        #PatientID -> [(block position, transaction position)], built on first use
+        self.patient_index = None
+
+        #timestamp of every Block in chain order, and transaction type ->
+        #[(block position, transaction position)], built on first query
+        self.block_times = None
+        self.type_index = None
+
+        #number of processes proof_of_work spreads the nonce search over
+        self.mining_workers = mining_workers
+        self._mining_pool = None
+        self._mining_pool_size = 0
+        self._found_proof = None
+        self._mining_lock = threading.Lock()
+        self._pool_lock = threading.Lock()
+
+        #held while the chain or the block tree changes, as blocks come from
+        #the miner, consensus and gossip on different threads
+        self.lock = threading.RLock()
+
+        #print every block valid_chain looks at
+        self.verbose = False
+
+        #pooled HTTP connections and threads used to talk to the other nodes
+        self.peer_timeout = PEER_TIMEOUT
+        self.consensus_timeout = CONSENSUS_TIMEOUT
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=PEER_FETCH_WORKERS, pool_maxsize=PEER_FETCH_WORKERS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        #peers that support it answer chain requests in the binary encoding
+        self.session.headers['Accept'] = f'{Codec.MIMETYPE}, application/json;q=0.9'
+        self._peer_executor = None
+
+        #'delta' only downloads the blocks we are missing, 'full' the whole chain
+        self.sync_mode = 'delta'
+
         #create the genesis block to start the blockchain
         self.new_block(previous_hash='1',proof=100)
 
-    def register_node(self,address, nodename):
+    def register_node(self,address, nodename=None):
         """
         Add a new node to the list of nodes
         :param address: Address of node. Eg. 'http://192.168.0.5:5000'
+        :param nodename: Unused, kept for callers that pass a name
         """
 
 
@@ -34,68 +853,508 @@ class Blockchain:
             raise ValueError('Invalid URL')
 
     
-    def valid_chain(self,chain):
+    def valid_chain(self,chain, verbose=False):
         """
         Determine if a given blockchain is valid
         :param chain: A blockchain
+        :param verbose: Print every block that is checked
         :return: True if valid, False if not
         """
-        last_block = chain[0]
-        current_index = 1
+        return self.verify_blocks(chain[0], self.hash(chain[0]), chain[1:], verbose) is not None
 
-        while current_index < len(chain):
-            block = chain[current_index]
-            print(f'{last_block}')
-            print(f'{block}')
-            print("\n-------------\n")
-            #check that the hash of the block is correct
+    def verify_blocks(self, last_block, last_block_hash, blocks, verbose=False):
+        """
+        Check that blocks extend last_block, spreading long runs over the worker pool
+        :param last_block: The trusted Block before blocks
+        :param last_block_hash: Hash of last_block
+        :param blocks: <list> Blocks to check
+        :param verbose: Print every block that is checked
+        :return: <list> hash of every block in blocks, or None if they are invalid
+        """
+        with VALID_CHAIN_SECONDS.timer():
+            if verbose or self.mining_workers <= 1 or len(blocks) < PARALLEL_VALIDATION_MIN_BLOCKS:
+                return self.check_blocks(last_block, last_block_hash, blocks, verbose)
+            return self.parallel_verify_blocks(last_block, last_block_hash, blocks)
+
+    def parallel_verify_blocks(self, last_block, last_block_hash, blocks):
+        """
+        verify_blocks for long runs, checked in segments on the worker pool
+        """
+        # Every segment carries the block before it, the worker hashes it
+        # itself so the segments can be checked independently
+        segment_size = -(-len(blocks) // (self.mining_workers * 4))
+        tasks = []
+        for start in range(0, len(blocks), segment_size):
+            if start == 0:
+                tasks.append((last_block, last_block_hash, blocks[:segment_size], DIFFICULTY))
+            else:
+                tasks.append((blocks[start - 1], None, blocks[start:start + segment_size], DIFFICULTY))
+
+        hashes = []
+        for segment_hashes in self.mining_pool().imap(_validate_segment, tasks):
+            if segment_hashes is None:
+                return None
+            hashes.extend(segment_hashes)
+        return hashes
+
+    @staticmethod
+    def check_blocks(last_block, last_block_hash, blocks, verbose=False):
+        """
+        Check the hash links and proofs of blocks one after another
+        :param last_block: The trusted Block before blocks
+        :param last_block_hash: Hash of last_block
+        :param blocks: <list> Blocks to check
+        :param verbose: Print every block that is checked
+        :return: <list> hash of every block in blocks, or None if they are invalid
+        """
+        hashes = []
 
-            last_block_hash = self.hash(last_block)
+        for block in blocks:
+            if verbose:
+                print(f'{last_block}')
+                print(f'{block}')
+                print("\n-------------\n")
+
+            #check that the hash of the block is correct
             if block['previous_hash'] != last_block_hash:
-                return False
-            
+                return None
 
             #check that the proof of work is correct
-            if not self.valid_proof(last_block['proof'], block['proof'], last_block_hash):
-                return False
-            
+            if not Blockchain.valid_proof(last_block['proof'], block['proof'], last_block_hash):
+                return None
+
+            #check that time does not go backwards, the query index bisects on it
+            if block['timestamp'] < last_block['timestamp']:
+                return None
+
+            #check that the transactions are the ones the header commits to
+            if not Blockchain.valid_body(block):
+                return None
+
             last_block = block
-            current_index +=1
-        
-        return True
+            last_block_hash = Blockchain.hash(block)
+            hashes.append(last_block_hash)
+
+        return hashes
+
+    @staticmethod
+    def valid_body(block):
+        """
+        Check that a Block's transactions match its Merkle root
+        :param block: Block
+        :return: True if they match or the Block has no Merkle root
+        """
+        return 'merkle_root' not in block or block['merkle_root'] == merkle_root(block['transactions'], block.get('version', 1))
 
     def resolve_conflicts(self):
         """
         This is our consensus algorithm, it resolves conflicts
-        by replacing our chain with the longest one in the network.
+        by switching our chain to the one with the most work in the network.
+        Branches fetched from peers are kept in the block tree, so coming
+        back to one later does not download or check it again.
         :return: True if our chain was replaced, False if not
         """
 
-        neighbours = self.nodes
-        new_chain = None
+        neighbours = list(self.nodes)
+
+        # Grab the chains from all the nodes in our network at once and
+        # verify each one as soon as it arrives
+        fetch = self.fetch_blocks if self.sync_mode == 'delta' else self.fetch_chain
+        counted = set()
+        futures = {self.peer_executor().submit(self.fetch_peer, fetch, node, counted): node for node in neighbours}
+        try:
+            for future in as_completed(futures, timeout=self.consensus_timeout):
+                try:
+                    fetched = future.result()
+                    if fetched is not None:
+                        self.add_fetched_branch(*fetched)
+                except PEER_ERRORS:
+                    # Dead, slow or broken peers do not hold up the rest
+                    count_fetch_failure(futures[future], counted)
+        except TimeoutError:
+            # Whatever has not answered by now is left out of this round
+            for future, node in futures.items():
+                if not future.done():
+                    count_fetch_failure(node, counted)
+                future.cancel()
+
+        # Switch to the branch with the most work if it is not ours
+        with self.lock:
+            return self.choose_tip()
+
+    def add_fetched_branch(self, length, parent_hash, blocks):
+        """
+        Check a branch downloaded from a peer and add it to the block tree if
+        it has more work than any branch we know
+        :param length: <int> Length of the peer's chain
+        :param parent_hash: <str> Hash of the Block before blocks, None if
+                            they start from their own genesis block
+        :param blocks: <list> The peer's blocks after it
+        :return: True if the branch was added, False if not
+        :raises ValueError: if the peer sent something that is not a branch
+        """
+        if not isinstance(length, int) or not isinstance(blocks, list):
+            raise ValueError('Peer sent a malformed branch')
+        for block in blocks:
+            problem = malformed_block(block)
+            if problem is not None:
+                raise ValueError(problem)
+
+        if not blocks or (parent_hash is not None and parent_hash not in self.work):
+            return False
+
+        # We're only looking for branches with more work than ours
+        parent_length = self.known_block(parent_hash)['index'] if parent_hash is not None else 0
+        work = self.work.get(parent_hash, 0) + len(blocks) * block_work()
+        if work <= self.work[self.best_tip()] or parent_length + len(blocks) != length:
+            return False
+
+        # Only the blocks after the one we share are checked and hashed
+        hashes = self.verified_branch(parent_hash, blocks, self.verbose)
+        if hashes is None:
+            return False
+
+        with self.lock:
+            self.add_branch(parent_hash, blocks, hashes)
+        return True
 
-        # We're only looking for chains longer than ours
-        max_length = len(self.chain)
+    def sync_from(self, node):
+        """
+        Download what one peer has that we are missing and switch to it if it has more work
+        :param node: Address of node. Eg. '192.168.0.5:5000'
+        :return: True if our chain was replaced, False if not
+        """
+        fetched = self.fetch_peer(self.fetch_blocks, node)
+        try:
+            if fetched is None or not self.add_fetched_branch(*fetched):
+                return False
+        except ValueError:
+            count_fetch_failure(node)
+            return False
 
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
+        with self.lock:
+            return self.choose_tip()
 
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
+    def add_block(self, block):
+        """
+        Add a single Block from a peer to the block tree and switch to it if
+        it gives a branch more work than our chain
+        :param block: Block
+        :return: <str> 'known', 'orphan' if we do not know the Block it
+                 builds on, 'invalid' or 'added'
+        """
+        block_hash = self.hash(block)
+        parent_hash = block['previous_hash']
+        if block_hash in self.work:
+            return 'known'
+        parent = self.known_block(parent_hash)
+        if parent is None:
+            return 'orphan'
+
+        if block['index'] != parent['index'] + 1 or self.verified_branch(parent_hash, [block]) != [block_hash]:
+            return 'invalid'
+
+        with self.lock:
+            self.add_branch(parent_hash, [block], [block_hash])
+            self.choose_tip()
+        return 'added'
+
+    def known_block(self, block_hash):
+        """
+        A Block we know of, in our chain or on another branch
+        :param block_hash: <str> Hash of the Block
+        :return: Block or None if we do not know it
+        """
+        position = self.block_positions.get(block_hash)
+        if position is not None:
+            return self.chain[position]
+        return self.side_blocks.get(block_hash)
 
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
+    def verified_branch(self, parent_hash, blocks, verbose=False):
+        """
+        Validate blocks that follow a Block we already know
+        :param parent_hash: <str> Hash of the Block before blocks, None if
+                            blocks is a whole chain starting from its own genesis block
+        :param blocks: <list> Blocks to check
+        :param verbose: Print every block that is checked
+        :return: <list> hash of every block in blocks, or None if they are invalid
+        """
+        if parent_hash is not None:
+            return self.verify_blocks(self.known_block(parent_hash), parent_hash, blocks, verbose)
+
+        # A genesis block is trusted as it is, only its body is checked
+        if not self.valid_body(blocks[0]):
+            return None
+        genesis_hash = self.hash(blocks[0])
+        hashes = self.verify_blocks(blocks[0], genesis_hash, blocks[1:], verbose)
+        if hashes is None:
+            return None
+        return [genesis_hash] + hashes
+
+    def add_branch(self, parent_hash, blocks, hashes):
+        """
+        Add verified blocks to the block tree next to our chain
+        :param parent_hash: <str> Hash of the known Block before blocks, None
+                            if they start from their own genesis block
+        :param blocks: <list> Blocks that follow it
+        :param hashes: <list> Hash of every block in blocks
+        """
+        work = self.work.get(parent_hash, 0)
+        for block, block_hash in zip(blocks, hashes):
+            work += block_work()
+            self.tips.discard(block['previous_hash'])
+            if block_hash not in self.work:
+                self.work[block_hash] = work
+                self.side_blocks[block_hash] = block
+                self.tips.add(block_hash)
+
+    def best_tip(self):
+        """
+        The tip with the most cumulative work, our own tip wins a tie
+        :return: <str> Hash of the tip
+        """
+        return max(self.tips, key=lambda tip: (self.work[tip], tip == self.last_hash))
 
-        # Replace our chain if we discovered a new, valid chain longer than ours
-        if new_chain:
-            self.chain = new_chain
-            return True
+    def choose_tip(self):
+        """
+        Make the tip with the most work the tip of our chain
+        :return: True if our chain was replaced, False if not
+        """
+        tip = self.best_tip()
+        replaced = tip != self.last_hash
+        if replaced:
+            self.reorganize(tip)
+        self.prune_side_branches()
+        return replaced
+
+    def prune_side_branches(self, depth=SIDE_BRANCH_DEPTH):
+        """
+        Drop side branches whose tip is more than depth Blocks behind our
+        best tip, they would take that many Blocks of work to win. Blocks a
+        branch shares with one that stays are kept.
+        :param depth: <int> Number of Blocks
+        """
+        threshold = self.work[self.best_tip()] - depth * block_work()
+        stale = {tip for tip in self.tips if tip in self.side_blocks and self.work[tip] < threshold}
+        if not stale:
+            return
+
+        kept = set()
+        for tip in self.tips - stale:
+            block_hash = tip
+            while block_hash in self.side_blocks and block_hash not in kept:
+                kept.add(block_hash)
+                block_hash = self.side_blocks[block_hash]['previous_hash']
+
+        for tip in stale:
+            self.tips.discard(tip)
+            block_hash = tip
+            while block_hash in self.side_blocks and block_hash not in kept:
+                block = self.side_blocks.pop(block_hash)
+                del self.work[block_hash]
+                block_hash = block['previous_hash']
+
+    def reorganize(self, tip_hash):
+        """
+        Switch our chain to the branch ending at a side tip. Only the blocks
+        of that branch after the one it shares with our chain are moved, the
+        blocks it replaces stay in the tree as a side branch.
+        :param tip_hash: <str> Hash of a Block in side_blocks
+        """
+        blocks = []
+        hashes = []
+        block_hash = tip_hash
+        while block_hash in self.side_blocks:
+            block = self.side_blocks[block_hash]
+            blocks.append(block)
+            hashes.append(block_hash)
+            block_hash = block['previous_hash']
+        blocks.reverse()
+        hashes.reverse()
+
+        # The branch either forks off a block of our chain or has its own genesis block
+        position = self.block_positions.get(block_hash)
+        fork = position + 1 if position is not None else 0
+
+        for block, block_hash in zip(self.chain[fork:], self.hashes[fork:]):
+            self.side_blocks[block_hash] = block
+        self.replace_chain(fork, blocks, hashes)
+        for block_hash in hashes:
+            del self.side_blocks[block_hash]
+
+    def replace_chain(self, fork, blocks, hashes):
+        """
+        Swap everything after the first fork blocks of our chain for verified blocks
+        :param fork: <int> Number of our blocks to keep
+        :param blocks: <list> Blocks that follow them
+        :param hashes: <list> Hash of every block in blocks
+        """
+        for block_hash in self.hashes[fork:]:
+            self.block_positions.pop(block_hash, None)
+        if self.patient_index is not None:
+            self.unindex_patients(fork)
+        if self.block_times is not None:
+            self.unindex_blocks(fork)
+        displaced = [transaction for block in self.chain[fork:] for transaction in block['transactions']]
+        displaced_hashes = [transaction_hash(transaction) for transaction in displaced]
+        self.recent.uncommit(displaced_hashes)
+
+        # Records the new blocks already hold must not be sealed again
+        block_leaves = [[transaction_hash(transaction) for transaction in block['transactions']] for block in blocks]
+        self.mempool.discard(digest for leaves in block_leaves for digest in leaves)
+        for block, leaves in zip(blocks, block_leaves):
+            self.recent.commit(block['index'], leaves)
+
+        # Records only the replaced blocks held go back to the mempool, their
+        # clients were already told they would be in a Block. They were
+        # accepted once, so they go in even when it is full.
+        # Identical records sent under different keys are counted apart.
+        kept = Counter(digest for leaves in block_leaves for digest in leaves)
+        orphaned = []
+        for transaction, digest in zip(displaced, displaced_hashes):
+            if kept[digest]:
+                kept[digest] -= 1
+            else:
+                orphaned.append((transaction, digest))
+        if orphaned:
+            self.mempool.add_many([transaction for transaction, _ in orphaned], force=True, hashes=[digest for _, digest in orphaned])
+
+        if self.store is not None:
+            self.store.truncate(fork)
+            self.store.extend(blocks, hashes)
+        else:
+            self.chain = self.chain[:fork] + blocks
+        self.hashes = self.hashes[:fork] + hashes
+
+        for position, block_hash in enumerate(hashes, fork):
+            self.block_positions[block_hash] = position
+        if self.patient_index is not None:
+            for position, block in enumerate(blocks, fork):
+                self.index_patients(position, block)
+        if self.block_times is not None:
+            for position, block in enumerate(blocks, fork):
+                self.index_block(position, block)
 
-        return False
+    @staticmethod
+    def fetch_peer(fetch, node, counted=None):
+        """
+        Run fetch(node), recording how long the peer took and whether it failed
+        :param counted: <set> Peers whose failure is already counted, see count_fetch_failure
+        """
+        started = perf_counter()
+        try:
+            return fetch(node)
+        except Exception:
+            count_fetch_failure(node, counted)
+            raise
+        finally:
+            PEER_FETCH_SECONDS.labels(node).observe(perf_counter() - started)
+
+    def fetch_chain(self, node):
+        """
+        Download the whole chain of another node
+        :param node: Address of node. Eg. '192.168.0.5:5000'
+        :return: <tuple> (length, parent_hash, blocks) as for fetch_blocks, or
+                 None if the node did not answer with a chain we do not have
+        :raises requests.HTTPError: if the node answers with an error
+        """
+        response = self.session.get(f'http://{node}/deskchain', timeout=self.peer_timeout)
+        response.raise_for_status()
+
+        values = self.decode_response(response)
+        chain = values['chain']
+        if not chain or self.hash(chain[-1]) in self.work:
+            return None
+
+        # Keep only the blocks after the last one we already know
+        for position in range(len(chain) - 1, 0, -1):
+            if chain[position]['previous_hash'] in self.work:
+                return values['length'], chain[position]['previous_hash'], chain[position:]
+        return values['length'], None, chain
+
+    def fetch_blocks(self, node):
+        """
+        Download only the blocks another node has that we are missing.
+        We ask for the blocks after our tip, then after the tips of our other
+        branches and, if the node knows none of them, after blocks of our chain
+        twice as far back each time until it knows one.
+        :param node: Address of node. Eg. '192.168.0.5:5000'
+        :return: <tuple> (length, parent_hash, blocks) where parent_hash is the
+                 hash of the Block before blocks, None if the node shares none
+                 of ours, or None if the node has nothing we are missing
+        :raises requests.HTTPError: if the node answers with an error
+        """
+        response = self.session.get(f'http://{node}/chain/tip', timeout=self.peer_timeout)
+        response.raise_for_status()
+
+        tip = response.json()
+        if not isinstance(tip, dict) or not isinstance(tip.get('hash'), str):
+            raise ValueError('Peer sent a malformed tip')
+        if tip['hash'] in self.work:
+            return None
+
+        hashes = self.hashes
+        side_tips = sorted(self.tips - {hashes[-1]}, key=self.work.get, reverse=True)
+        for block_hash in [hashes[-1]] + side_tips[:SIDE_TIPS_TRIED]:
+            fetched = self.fetch_blocks_after(node, block_hash)
+            if fetched is not None:
+                return fetched
+
+        position = len(hashes) - 1
+        step = 1
+        while position > 0:
+            position = max(0, position - step)
+            step *= 2
+            fetched = self.fetch_blocks_after(node, hashes[position])
+            if fetched is not None:
+                return fetched
+
+        # Not even our genesis block is shared, so take the whole chain
+        response = self.session.get(f'http://{node}/chain/blocks', params={'from': 1}, timeout=self.peer_timeout)
+        response.raise_for_status()
+
+        values = self.decode_response(response)
+        return values['length'], None, values['blocks']
+
+    @staticmethod
+    def decode_response(response):
+        """
+        The values in a peer's response, sent as JSON or in the binary Codec encoding
+        :param response: <requests.Response>
+        """
+        if response.headers.get('Content-Type', '').startswith(Codec.MIMETYPE):
+            return codec.decode(response.content, object_hook=record_from_dict)
+        return response.json(object_hook=record_from_dict)
+
+    def fetch_blocks_after(self, node, block_hash):
+        """
+        Download the blocks another node has after one of ours
+        :param node: Address of node. Eg. '192.168.0.5:5000'
+        :param block_hash: <str> Hash of a Block we know
+        :return: <tuple> (length, block_hash, blocks) or None if the node does not have the Block
+        :raises requests.HTTPError: if the node fails for another reason
+        """
+        response = self.session.get(
+            f'http://{node}/chain/blocks',
+            params={'after': block_hash},
+            timeout=self.peer_timeout,
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+
+        values = self.decode_response(response)
+        return values['length'], block_hash, values['blocks']
+
+    def peer_executor(self):
+        """
+        The thread pool peers are fetched on, created on first use
+        :return: <ThreadPoolExecutor>
+        """
+        with self._pool_lock:
+            if self._peer_executor is None:
+                self._peer_executor = ThreadPoolExecutor(max_workers=PEER_FETCH_WORKERS, thread_name_prefix='peer')
+            return self._peer_executor
 
     def new_block(self, proof, previous_hash):
         """
@@ -105,131 +1364,404 @@ class Blockchain:
         :return: New Block
         """
 
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': self.current_transactions,
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
+        with self.lock:
+            transactions = self.mempool.take(self.max_block_size)
+            leaves = [transaction_hash(transaction) for transaction in transactions]
+            # Never older than the Block before, which may come from a node
+            # whose clock is ahead of ours
+            timestamp = max(time(), self.chain[-1]['timestamp']) if len(self.chain) else time()
+            block = {
+                'index': len(self.chain) + 1,
+                'timestamp': timestamp,
+                'transactions': transactions,
+                'merkle_root': merkle_root(transactions, leaves=leaves),
+                'proof': proof,
+                'previous_hash': previous_hash or self.last_hash,
+                'version': BLOCK_VERSION,
+
+            }
+
+            block_hash = self.hash(block)
+            if self.store is not None:
+                self.store.append(block, block_hash)
+            else:
+                self.chain.append(block)
+            self.hashes.append(block_hash)
+            self.block_positions[block_hash] = len(self.hashes) - 1
+            self.work[block_hash] = self.work.get(block['previous_hash'], 0) + block_work()
+            self.tips.discard(block['previous_hash'])
+            self.tips.add(block_hash)
+            self.recent.commit(block['index'], leaves)
+            if self.patient_index is not None:
+                self.index_patients(len(self.hashes) - 1, block)
+            if self.block_times is not None:
+                self.index_block(len(self.hashes) - 1, block)
+            return block
+
+    def use_store(self, store):
+        """
+        Keep the chain in a BlockStore from now on. A store that already holds
+        blocks replaces the chain in memory, so a restarted node carries on
+        from where it stopped. An empty store is filled with our chain.
+        :param store: <BlockStore> or <TieredChain>
+        """
+        if len(store) == 0:
+            store.extend(self.chain, self.hashes)
+
+        self.store = store
+        self.chain = store
+        self.hashes = list(store.hashes)
+        self.block_positions = {block_hash: position for position, block_hash in enumerate(self.hashes)}
+        self.work = {block_hash: (position + 1) * block_work() for position, block_hash in enumerate(self.hashes)}
+        self.side_blocks = {}
+        self.tips = {self.hashes[-1]}
+        self.patient_index = None
+        self.block_times = None
+        self.type_index = None
+        self.remember_recent_blocks()
+
+    def remember_recent_blocks(self):
+        """
+        Fill the duplicate window from the newest Blocks of our chain
+        """
+        self.recent = RecentTransactions(self.recent.window)
+        position = len(self.chain)
+        remembered = 0
+        while position > 0 and remembered < self.recent.window:
+            position -= 1
+            remembered += len(self.chain[position]['transactions'])
+        for block in self.chain[position:]:
+            self.recent.commit(block['index'], [transaction_hash(transaction) for transaction in block['transactions']])
+
+    def follow_store(self):
+        """
+        Catch up with the blocks another process wrote to our store, for a
+        worker that reads a store opened readonly
+        """
+        with self.lock:
+            unchanged = self.store.refresh()
+            if unchanged == len(self.hashes) == len(self.store):
+                return
+
+            for block_hash in self.hashes[unchanged:]:
+                self.block_positions.pop(block_hash, None)
+                self.work.pop(block_hash, None)
+            del self.hashes[unchanged:]
+            for position, block_hash in enumerate(self.store.hashes[unchanged:], unchanged):
+                self.hashes.append(block_hash)
+                self.block_positions[block_hash] = position
+                self.work[block_hash] = (position + 1) * block_work()
+            self.tips = {self.hashes[-1]}
+            self.patient_index = None
+            self.block_times = None
+            self.type_index = None
+
+    def patient_history(self, patient_id):
+        """
+        Every record of a patient, committed and pending
+        :param patient_id: PatientID, compared as a string
+        :return: <tuple> (records, pending) where records are
+                 (Block, transaction position) pairs in chain order
+        """
+        if self.patient_index is None:
+            self.build_patient_index()
+
+        chain = self.chain
+        records = [(chain[block], transaction) for block, transaction in self.patient_index.get(str(patient_id), [])]
+        pending = [transaction for transaction in self.mempool.pending() if str(transaction['PatientID']) == str(patient_id)]
+        return records, pending
 
-        }
+    def build_patient_index(self):
+        """
+        Index the PatientID of every transaction in the chain
+        """
+        self.patient_index = {}
+        for position, block in enumerate(self.chain):
+            self.index_patients(position, block)
 
-        #reset the current list of transactions
-        self.current_transactions = []
+    def index_patients(self, position, block):
+        """
+        Add the transactions of a Block to the patient index
+        :param position: <int> Position of the Block in the chain
+        :param block: Block
+        """
+        for transaction_position, transaction in enumerate(block['transactions']):
+            self.patient_index.setdefault(str(transaction['PatientID']), []).append((position, transaction_position))
 
-        self.chain.append(block)
-        return block
+    def unindex_patients(self, fork):
+        """
+        Drop the transactions of every Block after the first fork from the patient index
+        :param fork: <int> Number of Blocks that stay indexed
+        """
+        for block in self.chain[fork:]:
+            for transaction in block['transactions']:
+                records = self.patient_index.get(str(transaction['PatientID']))
+                # Records are kept in chain order, so the dropped ones are at the end
+                while records and records[-1][0] >= fork:
+                    records.pop()
+                if not records:
+                    self.patient_index.pop(str(transaction['PatientID']), None)
+
+    def query(self, start=None, end=None, type_name=None, limit=None):
+        """
+        Committed transactions by the time of their Block and by type. Block
+        timestamps only grow along the chain, so the Blocks in a time range
+        are found by bisection, and the transactions of a type in them by
+        bisecting its list in the type index.
+        :param start: <float> Earliest Block timestamp, None for no limit
+        :param end: <float> Block timestamps must be before this, None for no limit
+        :param type_name: <str> Only transactions of this type, None for all
+        :param limit: <int> Most records returned, None for no limit
+        :return: <list> (Block, transaction position) pairs in chain order
+        """
+        if self.block_times is None:
+            self.build_query_index()
+
+        block_times = self.block_times
+        first = 0 if start is None else bisect_left(block_times, start)
+        stop = len(block_times) if end is None else bisect_left(block_times, end)
+
+        if type_name is None:
+            records = []
+            for block in self.chain[first:stop]:
+                records.extend((block, position) for position in range(len(block['transactions'])))
+                if limit is not None and len(records) >= limit:
+                    break
+            return records[:limit]
+
+        postings = self.type_index.get(type_name, [])
+        low = bisect_left(postings, (first,))
+        high = bisect_left(postings, (stop,))
+        if limit is not None:
+            high = min(high, low + limit)
+
+        records = []
+        block_position = block = None
+        for position, transaction_position in postings[low:high]:
+            # Transactions of one Block are next to each other, fetch it once
+            if position != block_position:
+                block_position, block = position, self.chain[position]
+            records.append((block, transaction_position))
+        return records
+
+    def build_query_index(self):
+        """
+        Index the timestamp of every Block and the type of every transaction in the chain
+        """
+        self.block_times = []
+        self.type_index = {}
+        for position, block in enumerate(self.chain):
+            self.index_block(position, block)
+
+    def index_block(self, position, block):
+        """
+        Add a Block to the query index
+        :param position: <int> Position of the Block in the chain
+        :param block: Block
+        """
+        self.block_times.append(block['timestamp'])
+        for transaction_position, transaction in enumerate(block['transactions']):
+            self.type_index.setdefault(transaction_type(transaction), []).append((position, transaction_position))
+
+    def unindex_blocks(self, fork):
+        """
+        Drop every Block after the first fork from the query index
+        :param fork: <int> Number of Blocks that stay indexed
+        """
+        del self.block_times[fork:]
+        for postings in self.type_index.values():
+            # Postings are kept in chain order, so the dropped ones are at the end
+            while postings and postings[-1][0] >= fork:
+                postings.pop()
     
-    def new_transaction_desk(self, PatientID, PatientName, PatientSurname, CovidStatus, Dateofcertificate, Temperature):
+    def new_transaction(self, transaction, force=False):
         """
         Creates a new transaction to go into the next mined Block
-        :param sender: Address of the Sender
-        :param recipient: Address of the Recipient
-        :param amount: Amount
+        :param transaction: <Transaction> The record to add
+        :param force: <bool> Add it even when the mempool is full
         :return: The index of the Block that will hold this transaction
+        :raises MempoolFull: if the mempool has no room for it
         """
+        self.mempool.add(transaction, force)
+        return self.last_block['index'] + 1
 
-        self.current_transactions.append({
-            'PatientID': PatientID,
-            'PatientName': PatientName,
-            'PatientSurname': PatientSurname,
-            'CovidStatus': CovidStatus,
-            'Temperature':Temperature,
-            'DateofCertificate': Dateofcertificate
+    def new_transactions(self, transactions, keys=None):
+        """
+        Adds many transactions to the next mined Block in one go. Any we
+        already have, pending or in a recent Block, is left out, so clients
+        can safely retry. A transaction sent with an idempotency key is only
+        a duplicate of the one sent with the same key, so identical records
+        sent under different keys are all kept. One sent without a key is a
+        duplicate of any we have with the same content.
+        :param transactions: <list> The records to add
+        :param keys: <list> Idempotency key sent with each record, or None
+        :return: <tuple> (index of the Block that will hold them, duplicates)
+                 where duplicates maps the position of every record left out
+                 to the index of the Block that holds or will hold its copy
+        :raises MempoolFull: if the mempool has no room for all of them
+        """
+        hashes = [transaction_hash(transaction) for transaction in transactions]
+        if keys is None:
+            keys = [None] * len(transactions)
+
+        # Held so a retry can not slip in between the check and the add, or
+        # miss a copy that is on its way from the mempool into a Block
+        with self.lock:
+            next_index = self.last_block['index'] + 1
+            new = []
+            new_hashes = set()
+            new_keys = set()
+            duplicates = {}
+            for position, (digest, key) in enumerate(zip(hashes, keys)):
+                if key is None:
+                    index = next_index if digest in new_hashes else self.known_index(digest, next_index)
+                else:
+                    index = next_index if key in new_keys else self.known_index(self.recent.key_hash(key), next_index)
+                if index is not None:
+                    duplicates[position] = index
+                    continue
+                new.append(position)
+                new_hashes.add(digest)
+                if key is not None:
+                    new_keys.add(key)
+
+            if new:
+                self.mempool.add_many([transactions[position] for position in new], hashes=[hashes[position] for position in new])
+            for position in new:
+                if keys[position] is not None:
+                    self.recent.remember_key(keys[position], hashes[position])
+        return next_index, duplicates
+
+    def known_index(self, digest, next_index):
+        """
+        Index of the Block that holds or will hold a transaction we have
+        :param digest: <bytes> Hash of the transaction, or None
+        :param next_index: <int> Index of the next Block, for pending ones
+        :return: <int> or None if we do not have it
+        """
+        if digest is None:
+            return None
+        if digest in self.mempool:
+            return next_index
+        return self.recent.block_of(digest)
 
-        })
+    @property
+    def current_transactions(self):
+        return self.mempool.pending()
+
+    def new_transaction_desk(self, PatientID, PatientName, PatientSurname, CovidStatus, Dateofcertificate, Temperature):
+        """
+        Creates a new transaction to go into the next mined Block
+        :return: The index of the Block that will hold this transaction
+        """
+        return self.new_transaction(DeskTransaction(
+            PatientID=PatientID,
+            PatientName=PatientName,
+            PatientSurname=PatientSurname,
+            CovidStatus=CovidStatus,
+            Temperature=Temperature,
+            DateofCertificate=Dateofcertificate,
+        ))
 
-        return self.last_block['index'] +  1
-    
     def new_transaction_admission(self,PatientID, NextofKin, Gender, Age, DOB, IDNumber, MaritalStatus, EmailAddress, MedicalAid, MedicalAidNumber, ConsultationFee, TestsFee):
 
-        self.current_transactions.append({
-            'PatientID': PatientID,
-            'NextofKin': NextofKin,
-            'Gender': Gender,
-            'Age': Age,
-            'DOB': DOB,
-            'IDNumber': IDNumber,
-            'MaritalStatus': MaritalStatus,
-            'EmailAddress': EmailAddress,
-            'MedicalAid': MedicalAid,
-            'MedicalAidNumber': MedicalAidNumber,
-            'ConsultationFee': ConsultationFee,
-            'TestsFee': TestsFee,
-
-
-        })
-        return self.last_block['index'] + 1
-    
+        return self.new_transaction(AdmissionTransaction(
+            PatientID=PatientID,
+            NextofKin=NextofKin,
+            Gender=Gender,
+            Age=Age,
+            DOB=DOB,
+            IDNumber=IDNumber,
+            MaritalStatus=MaritalStatus,
+            EmailAddress=EmailAddress,
+            MedicalAid=MedicalAid,
+            MedicalAidNumber=MedicalAidNumber,
+            ConsultationFee=ConsultationFee,
+            TestsFee=TestsFee,
+        ))
+
     def new_transaction_Assessment(self, PatientID, Notes, Allergies, Symptoms, BP, Pulse, Temperature, Respirations, Oxygen, Weight, Height, PriorityLevel):
 
-        self.current_transactions.append({
-            'PatientID': PatientID,
-            'Notes': Notes, 
-            'Allergies': Allergies,
-            'Symptoms': Symptoms,
-            'BP': BP,
-            'Pulse': Pulse,
-            'Temperature': Temperature,
-            'Respirations': Respirations,
-            'Oxygen': Oxygen,
-            'Weight': Weight,
-            'Height': Height,
-            'PriorityLevel': PriorityLevel,
-        })
-        return self.last_block['index'] + 1
-    
+        return self.new_transaction(AssessmentTransaction(
+            PatientID=PatientID,
+            Notes=Notes,
+            Allergies=Allergies,
+            Symptoms=Symptoms,
+            BP=BP,
+            Pulse=Pulse,
+            Temperature=Temperature,
+            Respirations=Respirations,
+            Oxygen=Oxygen,
+            Weight=Weight,
+            Height=Height,
+            PriorityLevel=PriorityLevel,
+        ))
+
     def new_transaction_Doctor(self, PatientID, LabNotes, Diagnosis, prescription, recommendation):
 
-        self.current_transactions.append({
-            'PatientID': PatientID,
-            'LabNotes': LabNotes,
-            'Diagnosis': Diagnosis,
-            'Prescription': prescription,
-            'recommendation': recommendation,
+        return self.new_transaction(DoctorTransaction(
+            PatientID=PatientID,
+            LabNotes=LabNotes,
+            Diagnosis=Diagnosis,
+            Prescription=prescription,
+            recommendation=recommendation,
+        ))
 
-        })
-        return self.last_block['index'] + 1
-    
     def new_transaction_Lab(self, PatientID, BloodTest, Xray, UltraSound, Cultures, Lipid, Hemoglobin, urinanalysis, other):
 
-        self.current_transactions.append({
-            'PatientID': PatientID,
-            'BloodTest': BloodTest,
-            'Xray': Xray,
-            'UltraSound': UltraSound,
-            'Cultures': Cultures,
-            'Lipid': Lipid,
-            'Hemoglobin': Hemoglobin,
-            'urinanalysis': urinanalysis,
-            'other': other
-
-        })
-        return self.last_block['index'] + 1
-    
+        return self.new_transaction(LabTransaction(
+            PatientID=PatientID,
+            BloodTest=BloodTest,
+            Xray=Xray,
+            UltraSound=UltraSound,
+            Cultures=Cultures,
+            Lipid=Lipid,
+            Hemoglobin=Hemoglobin,
+            urinanalysis=urinanalysis,
+            other=other,
+        ))
+
     def new_transaction_Dispensary(self, PatientID, Medication):
-        
-        self.current_transactions.append({
-            'PatientID': PatientID,
-            'Medication': Medication,
-        })
-        return self.last_block['index'] + 1
-    
 
-    
+        return self.new_transaction(DispensaryTransaction(
+            PatientID=PatientID,
+            Medication=Medication,
+        ))
 
     @property
     def last_block(self):
         return self.chain[-1]
 
+    @property
+    def last_hash(self):
+        return self.hashes[-1]
+
+    def block_hash(self, block):
+        """
+        Hash of a Block, looked up instead of recomputed when it is in our chain
+        :param block: Block
+        """
+        position = block['index'] - 1
+        if 0 <= position < len(self.chain) and self.chain[position] is block:
+            return self.hashes[position]
+        return self.hash(block)
+
     @staticmethod
     def hash(block):
         """
             Creates a SHA-256 hash of a Block
             :param block: Block
         """
+        # Blocks with a Merkle root are hashed by their header only, the root
+        # stands in for the transactions. Version 2 headers are hashed in the
+        # Codec encoding, older ones as JSON, and older blocks hash everything.
+        if block.get('version', 1) >= 2:
+            return hashlib.sha256(codec.encode(block_header(block))).hexdigest()
+        if 'merkle_root' in block:
+            block = block_header(block)
+
         # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
-        block_string = json.dumps(block, sort_keys=True).encode()
+        block_string = json.dumps(block, sort_keys=True, default=json_default).encode()
         return hashlib.sha256(block_string).hexdigest()
 
     def proof_of_work(self, last_block):
@@ -243,13 +1775,74 @@ class Blockchain:
         """
 
         last_proof = last_block['proof']
-        last_hash = self.hash(last_block)
-
-        proof = 0
-        while self.valid_proof(last_proof, proof, last_hash) is False:
-            proof += 1
+        last_hash = self.block_hash(last_block)
 
+        started = perf_counter()
+        if self.mining_workers > 1:
+            proof = self.parallel_proof_of_work(last_proof, last_hash)
+        else:
+            start = 0
+            while True:
+                proof = search_proof(last_proof, last_hash, start, start + MINING_BATCH_SIZE)
+                if proof is not None:
+                    break
+                start += MINING_BATCH_SIZE
+        elapsed = perf_counter() - started
+
+        # Every nonce up to the proof was hashed
+        HASHES.inc(proof + 1)
+        PROOF_OF_WORK_SECONDS.observe(elapsed)
+        if elapsed > 0:
+            HASH_RATE.set((proof + 1) / elapsed)
         return proof
+
+    def parallel_proof_of_work(self, last_proof, last_hash):
+        """
+        Proof of Work spread over a pool of mining_workers processes.
+        The nonce space is cut into chunks handed out in order, so the result
+        is the same lowest proof the single core search would find.
+
+        :param last_proof: <int> Previous Proof
+        :param last_hash: <str> The hash of the Previous Block
+        :return: <int>
+        """
+        with self._mining_lock:
+            pool = self.mining_pool()
+            self._found_proof.value = sys.maxsize
+
+            # Hand out a few chunks per worker each round to keep them all busy
+            tasks_per_round = self._mining_pool_size * 4
+            start = 0
+            while True:
+                tasks = [
+                    (last_proof, last_hash, chunk, chunk + MINING_CHUNK_SIZE, DIFFICULTY)
+                    for chunk in range(start, start + tasks_per_round * MINING_CHUNK_SIZE, MINING_CHUNK_SIZE)
+                ]
+                proofs = [proof for proof in pool.map(_search_proof, tasks, chunksize=1) if proof is not None]
+                if proofs:
+                    return min(proofs)
+
+                start += tasks_per_round * MINING_CHUNK_SIZE
+
+    def mining_pool(self):
+        """
+        The process pool used for mining and chain validation, (re)created when mining_workers changes
+        :return: <multiprocessing.Pool>
+        """
+        with self._pool_lock:
+            if self._mining_pool is None or self._mining_pool_size != self.mining_workers:
+                if self._mining_pool is not None:
+                    self._mining_pool.terminate()
+
+                self._found_proof = multiprocessing.Value('q', sys.maxsize)
+                self._mining_pool = multiprocessing.Pool(
+                    self.mining_workers,
+                    initializer=_init_mining_worker,
+                    initargs=(self._found_proof,),
+                )
+                self._mining_pool_size = self.mining_workers
+
+            return self._mining_pool
     
     @staticmethod
     def valid_proof(last_proof, proof, last_hash):
@@ -262,11 +1855,363 @@ class Blockchain:
         """
 
         guess = f'{last_proof}{proof}{last_hash}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        return meets_difficulty(hashlib.sha256(guess).digest())
     
+class Miner:
+    """
+    Background miner. /mine* requests only queue a job and return its id,
+    the proof of work runs on this thread. It also seals the pending
+    transactions into a block on its own once there are seal_threshold of
+    them or the oldest has waited max_wait seconds, so many records share
+    one proof.
+    """
+
+    # Finished jobs kept around for the status endpoint
+    MAX_FINISHED_JOBS = 1000
+
+    def __init__(self, blockchain, seal_threshold=100, max_wait=60, poll_interval=1):
+        self.blockchain = blockchain
+        self.seal_threshold = seal_threshold
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+
+        self.jobs = OrderedDict()
+        self.queue = queue.Queue()
+
+        #called with every Block the miner forges
+        self.on_block = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the mining thread if it is not running yet
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='miner', daemon=True)
+                self._thread.start()
+
+    def submit(self, reward=None, route='seal'):
+        """
+        Queue a mining job
+        :param reward: <callable> builds the reward transaction once the proof is found
+        :param route: <str> the /mine route that asked for the job, for the metrics
+        :return: <dict> the job
+        """
+        job = {
+            'id': uuid4().hex,
+            'status': 'queued',
+            'submitted': time(),
+            'started': None,
+            'finished': None,
+            'block': None,
+            'error': None,
+        }
+
+        with self._lock:
+            self.jobs[job['id']] = job
+            self._forget_finished_jobs()
+
+        self.queue.put((job, reward, route))
+        self.start()
+        return job
+
+    def status(self, job_id):
+        """
+        Current state of a job
+        :param job_id: <str>
+        :return: <dict> or None if the job is unknown
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+
+        status = dict(job)
+        if job['status'] == 'queued':
+            with self.queue.mutex:
+                queued = [queued_job['id'] for queued_job, _, _ in self.queue.queue]
+            status['position'] = queued.index(job_id) + 1 if job_id in queued else 0
+        return status
+
+    def run(self):
+        while True:
+            try:
+                job, reward, route = self.queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                # Keep sealing while a backlog is bigger than one Block. A
+                # failure must not stop the thread, it is tried again after
+                # the next poll_interval
+                try:
+                    while self.should_seal():
+                        self.forge()
+                        BLOCKS_MINED.labels('seal').inc()
+                except Exception as e:
+                    print(f'Sealing pending transactions failed: {e}', file=sys.stderr)
+                continue
+
+            job['status'] = 'mining'
+            job['started'] = time()
+            try:
+                job['block'] = self.forge(reward)
+                job['status'] = 'done'
+                BLOCKS_MINED.labels(route).inc()
+            except Exception as e:
+                job['status'] = 'failed'
+                job['error'] = str(e)
+            job['finished'] = time()
+
+    def should_seal(self):
+        """
+        Whether the pending transactions should be sealed without a mining request
+        :return: <bool>
+        """
+        pending = len(self.blockchain.mempool)
+        if not pending:
+            return False
+
+        return pending >= self.seal_threshold or self.blockchain.mempool.oldest_wait() >= self.max_wait
+
+    def forge(self, reward=None):
+        """
+        Find the proof for the next block and forge it
+        :param reward: <callable> builds the reward transaction once the proof is found
+        :return: <dict> the new Block
+        """
+        # If consensus or gossip swaps our chain while we mine, the proof is
+        # for a stale block and has to be found again
+        while True:
+            last_block = self.blockchain.last_block
+            previous_hash = self.blockchain.block_hash(last_block)
+            proof = self.blockchain.proof_of_work(last_block)
+            with self.blockchain.lock:
+                if previous_hash != self.blockchain.last_hash:
+                    continue
+
+                # The reward goes in even when the mempool is full, the new Block
+                # is about to empty it
+                if reward is not None:
+                    self.blockchain.new_transaction(reward(), force=True)
+
+                # Forge the new Block by adding it to the chain
+                block = self.blockchain.new_block(proof, previous_hash)
+
+            if self.on_block is not None:
+                self.on_block(block)
+            return block
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job['finished'] is not None]
+        for job_id in finished[:max(0, len(finished) - self.MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+
+class Gossip:
+    """
+    Pushes new blocks and transactions to our peers as soon as we have them,
+    instead of waiting for them to pull our chain on /nodes/resolve.
+
+    Everything is sent to at most fanout randomly chosen peers, which check
+    it and pass it on in turn. Hashes of what was already seen are
+    remembered, so nothing is applied or sent on twice. Transactions are
+    gathered for batch_wait seconds and pushed together. Sending happens
+    on a thread pool of its own, so it never holds up the request, the
+    miner or the consensus fetches, and when queue_size pushes are already
+    waiting new ones are dropped: peers catch up on their next consensus
+    round.
+    """
+
+    def __init__(self, blockchain, fanout=GOSSIP_FANOUT, seen_size=GOSSIP_SEEN_SIZE,
+                 queue_size=GOSSIP_QUEUE_SIZE, batch_wait=GOSSIP_BATCH_WAIT, batch_size=GOSSIP_BATCH_SIZE):
+        self.blockchain = blockchain
+        self.fanout = fanout
+        self.seen_size = seen_size
+        self.batch_wait = batch_wait
+        self.batch_size = batch_size
+
+        #port this node listens on, sent along so peers can sync from us
+        self.port = None
+
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+        #peers to leave out -> transactions waiting to be pushed to the rest
+        self._pending = {}
+        self._pending_count = 0
+        self._flush_timer = None
+
+        self._executor = None
+        self._slots = threading.Semaphore(queue_size)
+
+    def remember(self, digest):
+        """
+        Mark a block or transaction hash as seen
+        :param digest: Hash of a block or transaction
+        :return: True if it was not seen before
+        """
+        with self._lock:
+            if digest in self._seen:
+                return False
+            self._seen[digest] = None
+            if len(self._seen) > self.seen_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def forget(self, digests):
+        """
+        Unmark block or transaction hashes, so they are taken again when resent
+        :param digests: Hashes passed to remember
+        """
+        with self._lock:
+            for digest in digests:
+                self._seen.pop(digest, None)
+
+    def announce_block(self, block, exclude=()):
+        """
+        Push a Block to our peers
+        :param block: Block
+        :param exclude: Peers that already have it
+        """
+        self.remember(self.blockchain.block_hash(block))
+        self.send('/gossip/block', {'block': block}, exclude)
+
+    def announce_transactions(self, transactions, exclude=()):
+        """
+        Push transactions to our peers, together with the others announced
+        in the next batch_wait seconds
+        :param transactions: <list> of <Transaction>
+        :param exclude: Peers that already have them
+        """
+        for transaction in transactions:
+            self.remember(transaction_hash(transaction))
+
+        with self._lock:
+            self._pending.setdefault(tuple(exclude), []).extend(transactions)
+            self._pending_count += len(transactions)
+            flush = self.batch_wait <= 0 or self._pending_count >= self.batch_size
+            if not flush and self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.batch_wait, self.flush_transactions)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        if flush:
+            self.flush_transactions()
+
+    def flush_transactions(self):
+        """
+        Push the transactions waiting for their batch now
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_count = 0
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+        for exclude, transactions in pending.items():
+            items = [dict(transaction.to_dict(), type=transaction.type) for transaction in transactions]
+            self.send('/gossip/transactions', {'transactions': items}, exclude)
+
+    def receive_block(self, block, sender=None):
+        """
+        Apply a Block pushed by a peer and pass it on if it is new and valid.
+        A Block that builds on one we do not know means we missed some, so
+        we sync from the sender instead.
+        :param block: Block
+        :param sender: Address the peer listens on, if it told us
+        :return: <str> result of Blockchain.add_block, or 'seen'
+        """
+        if not self.remember(self.blockchain.hash(block)):
+            result = 'seen'
+        else:
+            result = self.blockchain.add_block(block)
+            if result == 'added':
+                self.announce_block(block, exclude=(sender,))
+            elif result == 'orphan' and sender is not None:
+                self.blockchain.peer_executor().submit(self.blockchain.sync_from, sender)
+
+        GOSSIP_RECEIVED.labels('block', result).inc()
+        return result
+
+    def receive_transactions(self, transactions, sender=None):
+        """
+        Add transactions pushed by a peer to the mempool and pass the new ones on
+        :param transactions: <list> of <Transaction>
+        :param sender: Address the peer listens on, if it told us
+        :return: <int> number of new transactions
+        :raises MempoolFull: if the mempool has no room for them
+        """
+        new = [transaction for transaction in transactions if self.remember(transaction_hash(transaction))]
+        if new:
+            try:
+                _, duplicates = self.blockchain.new_transactions(new)
+            except MempoolFull:
+                # None of them were taken, so a retry must not be turned away as seen
+                self.forget([transaction_hash(transaction) for transaction in new])
+                raise
+            new = [transaction for position, transaction in enumerate(new) if position not in duplicates]
+        if new:
+            self.announce_transactions(new, exclude=(sender,))
+
+        GOSSIP_RECEIVED.labels('transaction', 'added').inc(len(new))
+        GOSSIP_RECEIVED.labels('transaction', 'seen').inc(len(transactions) - len(new))
+        return len(new)
+
+    def send(self, path, values, exclude=()):
+        """
+        Post values to up to fanout of our peers, without waiting for them
+        """
+        peers = list(self.blockchain.nodes - set(exclude))
+        if not peers or self.fanout <= 0:
+            return
+
+        values = dict(values, port=self.port)
+        body = json.dumps(values, default=json_default)
+        for peer in random.sample(peers, min(self.fanout, len(peers))):
+            if not self._slots.acquire(blocking=False):
+                GOSSIP_DROPPED.inc()
+                continue
+            self.executor().submit(self.post, peer, path, body)
+
+    def executor(self):
+        """
+        The thread pool pushes are sent on, created on first use
+        :return: <ThreadPoolExecutor>
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=GOSSIP_WORKERS, thread_name_prefix='gossip')
+            return self._executor
+
+    def post(self, peer, path, body):
+        try:
+            self.blockchain.session.post(
+                f'http://{peer}{path}',
+                data=body,
+                headers={'Content-Type': 'application/json'},
+                timeout=self.blockchain.peer_timeout,
+            )
+        except requests.RequestException:
+            # The peer catches up on its next consensus round
+            pass
+        finally:
+            self._slots.release()
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that writes transaction records as dicts
+    """
+
+    @staticmethod
+    def default(value):
+        if isinstance(value, Transaction):
+            return value.to_dict()
+        return DefaultJSONProvider.default(value)
+
+
 #Instantiate the node
 app = Flask(__name__)
+app.json = JSONProvider(app)
 
 #generate a globally unique address for this node
 node_identifier = str(uuid4()).replace('-','')
@@ -274,370 +2219,731 @@ node_identifier = str(uuid4()).replace('-','')
 #Instantiate the blockchain
 blockchain = Blockchain()
 
+#Instantiate the background miner
+miner = Miner(blockchain)
+
+#Push what we mine and receive to our peers
+gossip = Gossip(blockchain)
+miner.on_block = gossip.announce_block
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = perf_counter()
+
+
+@app.after_request
+def observe_request_time(response):
+    # Streamed bodies are still being sent, only the time to start them counts
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_SECONDS.labels(route).observe(perf_counter() - started)
+        REQUEST_BYTES.labels(route).inc(request.content_length or 0)
+        RESPONSE_BYTES.labels(route).inc(response.content_length or 0)
+    return response
+
+
+#address of the process that owns the chain when this process is a worker
+#that only serves reads, None when this process owns it
+owner = None
+owner_session = None
+
+#directory worker processes write their metrics to, set in the process that
+#owns the chain when it has workers
+worker_metrics_dir = None
+
+# Endpoints a worker answers itself from the shared store, everything else
+# changes the chain or needs the mempool or the peers and goes to the owner
+WORKER_ENDPOINTS = {'full_chain', 'chain_tip', 'chain_blocks', 'transaction_proof', 'query_transactions'}
+
+
+def use_owner(address, data_dir):
+    """
+    Make this process a worker of the owner process at address: it reads
+    the chain from the owner's store in data_dir and forwards every other
+    request to the owner
+    """
+    global blockchain, owner, owner_session
+
+    store = BlockStore(data_dir, Blockchain.hash, default=json_default, object_hook=record_from_dict, readonly=True)
+    blockchain = Blockchain()
+    blockchain.use_store(store)
+    owner = address
+    owner_session = requests.Session()
+
+    # Start counting from zero, the owner already reports what came before the fork
+    registry.clear()
+
+
+def run_worker(fd, owner_address, data_dir):
+    use_owner(owner_address, data_dir)
+    path = os.path.join(data_dir, 'metrics', f'worker-{os.getpid()}.prom')
+    threading.Thread(target=write_worker_metrics, args=(path,), name='metrics', daemon=True).start()
+    make_server('0.0.0.0', 0, app, threaded=True, fd=fd).serve_forever()
+
+
+def write_worker_metrics(path):
+    """
+    Write this worker's metrics to path every WORKER_METRICS_INTERVAL seconds
+    """
+    while True:
+        with open(path + '.tmp', 'w') as f:
+            f.write(registry.render())
+        os.replace(path + '.tmp', path)
+        sleep(WORKER_METRICS_INTERVAL)
+
+
+def read_worker_metrics():
+    """
+    The metrics last written by every worker process
+    :return: <list> of <str> in the Prometheus text format
+    """
+    texts = []
+    for name in sorted(os.listdir(worker_metrics_dir)):
+        if name.endswith('.prom'):
+            try:
+                with open(os.path.join(worker_metrics_dir, name)) as f:
+                    texts.append(f.read())
+            except FileNotFoundError:
+                continue
+    return texts
+
+
+def start_workers(processes, listener, owner_address, data_dir):
+    """
+    Fork worker processes that all accept connections on listener, the
+    kernel spreads the connections over them
+    :return: <list> of <multiprocessing.Process>
+    """
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for _ in range(processes):
+        worker = context.Process(target=run_worker, args=(listener.fileno(), owner_address, data_dir), daemon=True)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+@app.before_request
+def serve_as_worker():
+    if owner is None:
+        return None
+    if request.endpoint in WORKER_ENDPOINTS:
+        blockchain.follow_store()
+        return None
+    return forward_to_owner()
+
+
+def forward_to_owner():
+    # The owner records the request in its own metrics
+    g.pop('request_started', None)
+
+    headers = {
+        header: request.headers[header]
+        for header in ('Content-Type', 'Accept', 'Idempotency-Key')
+        if header in request.headers
+    }
+    # The owner sees the client's address, gossip syncs back from it
+    headers['X-Forwarded-For'] = request.remote_addr
+
+    response = owner_session.request(
+        request.method,
+        f'http://{owner}{request.full_path}',
+        data=request.get_data(),
+        headers=headers,
+        timeout=(PEER_TIMEOUT, None),
+    )
+    headers = {
+        header: response.headers[header]
+        for header in ('Content-Type', 'Retry-After', 'Vary')
+        if header in response.headers
+    }
+    return Response(response.content, status=response.status_code, headers=headers)
 
-@app.route('/mine', methods=['GET'])
-def mine():
-    # We run the proof of work algorithm to get the next proof...
-    last_block = blockchain.last_block
-    proof = blockchain.proof_of_work(last_block)
-
-    
-
-    # We must receive a reward for finding the proof.
-    # The sender is "0" to signify that this node has mined a new coin.
-    blockchain.new_transaction_desk(
-        PatientID = 0,
-        PatientSurname = node_identifier,
-        PatientName = "Genesis Block",
-        CovidStatus = "Genesis Block",
-        Temperature = "Genesis Block",
-        Dateofcertificate = "Genesis Block"
-        
-    ) 
-
-    # Forge the new Block by adding it to the chain
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.new_block(proof, previous_hash)
 
-    response = {
+def block_response(block):
+    return {
         'message': "New Block Forged",
         'index': block['index'],
         'transactions': block['transactions'],
         'proof': block['proof'],
         'previous_hash': block['previous_hash'],
     }
-    return jsonify(response), 200
 
-@app.route('/mineadmission', methods=['GET'])
-def mineAdmin():
-    # We run the proof of work algorithm to get the next proof...
-    last_block = blockchain.last_block
-    proof = blockchain.proof_of_work(last_block)
 
-    
+def mining_job_response(job):
+    response = {
+        'message': 'Mining job queued',
+        'job': job['id'],
+        'status': f'/mine/jobs/{job["id"]}',
+    }
+    return jsonify(response), 202
 
-    # We must receive a reward for finding the proof.
-    # The sender is "0" to signify that this node has mined a new coin.
-    blockchain.new_transaction_admission(
-        PatientID = node_identifier,
-        NextofKin =  "Genesis Block",
-        Gender = "Genesis Block",
-        Age = "Genesis Block",
-        DOB = "Genesis Block",
-        IDNumber= 'IDNumber',
-        MaritalStatus = 'MaritalStatus',
-        EmailAddress = 'EmailAddress',
-        MedicalAid = 'MedicalAid',
-        MedicalAidNumber = 'MedicalAidNumber',
-        ConsultationFee =  'ConsultationFee',
-        TestsFee = 'TestsFee',
-    
-        
-    ) 
 
-    # Forge the new Block by adding it to the chain
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.new_block(proof, previous_hash)
+@app.route('/mine/jobs/<job_id>', methods=['GET'])
+def mining_job(job_id):
+    job = miner.status(job_id)
+    if job is None:
+        return 'Unknown mining job', 404
 
-    response = {
-        'message': "New Block Forged",
-        'index': block['index'],
-        'transactions': block['transactions'],
-        'proof': block['proof'],
-        'previous_hash': block['previous_hash'],
-    }
-    return jsonify(response), 200
+    block = job.pop('block')
+    if block is not None:
+        job.update(block_response(block))
+    return jsonify(job), 200
 
 
-@app.route('/mineassessment', methods=['GET'])
-def mineAssessment():
-    # We run the proof of work algorithm to get the next proof...
-    last_block = blockchain.last_block
-    proof = blockchain.proof_of_work(last_block)
+@app.route('/mine', methods=['GET'])
+def mine():
+    # The proof of work runs on the background miner, so we only queue a job.
+    # We must receive a reward for finding the proof, reward() builds its transaction.
+    # The sender is "0" to signify that this node has mined a new coin.
+    def reward():
+        return DeskTransaction(
+            PatientID = 0,
+            PatientSurname = node_identifier,
+            PatientName = "Genesis Block",
+            CovidStatus = "Genesis Block",
+            Temperature = "Genesis Block",
+            DateofCertificate = "Genesis Block"
+            
+        ) 
 
-    
+    return mining_job_response(miner.submit(reward, request.url_rule.rule))
 
-    # We must receive a reward for finding the proof.
+@app.route('/mineadmission', methods=['GET'])
+def mineAdmin():
+    # The proof of work runs on the background miner, so we only queue a job.
+    # We must receive a reward for finding the proof, reward() builds its transaction.
     # The sender is "0" to signify that this node has mined a new coin.
-    blockchain.new_transaction_Assessment(
-        PatientID = node_identifier,
-        Notes = 'Notes', 
-        Allergies = 'Allergies',
-        Symptoms = 'Symptoms',
-        BP =  'BP',
-        Pulse = 'Pulse',
-        Temperature = 'Temperature',
-        Respirations = 'Respirations',
-        Oxygen = 'Oxygen',
-        Weight = 'Weight',
-        Height = 'Height',
-        PriorityLevel= 'PriorityLevel',
-        
-       
-    
+    def reward():
+        return AdmissionTransaction(
+            PatientID = node_identifier,
+            NextofKin =  "Genesis Block",
+            Gender = "Genesis Block",
+            Age = "Genesis Block",
+            DOB = "Genesis Block",
+            IDNumber= 'IDNumber',
+            MaritalStatus = 'MaritalStatus',
+            EmailAddress = 'EmailAddress',
+            MedicalAid = 'MedicalAid',
+            MedicalAidNumber = 'MedicalAidNumber',
+            ConsultationFee =  'ConsultationFee',
+            TestsFee = 'TestsFee',
         
-    ) 
+            
+        ) 
 
-    # Forge the new Block by adding it to the chain
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.new_block(proof, previous_hash)
+    return mining_job_response(miner.submit(reward, request.url_rule.rule))
 
-    response = {
-        'message': "New Block Forged",
-        'index': block['index'],
-        'transactions': block['transactions'],
-        'proof': block['proof'],
-        'previous_hash': block['previous_hash'],
-    }
-    return jsonify(response), 200
+
+@app.route('/mineassessment', methods=['GET'])
+def mineAssessment():
+    # The proof of work runs on the background miner, so we only queue a job.
+    # We must receive a reward for finding the proof, reward() builds its transaction.
+    # The sender is "0" to signify that this node has mined a new coin.
+    def reward():
+        return AssessmentTransaction(
+            PatientID = node_identifier,
+            Notes = 'Notes', 
+            Allergies = 'Allergies',
+            Symptoms = 'Symptoms',
+            BP =  'BP',
+            Pulse = 'Pulse',
+            Temperature = 'Temperature',
+            Respirations = 'Respirations',
+            Oxygen = 'Oxygen',
+            Weight = 'Weight',
+            Height = 'Height',
+            PriorityLevel= 'PriorityLevel',
+            
+           
+        
+            
+        ) 
+
+    return mining_job_response(miner.submit(reward, request.url_rule.rule))
 
 
 @app.route('/mineDoctor', methods =['Get'])
 def mineDoc():
-    # We run the proof of work algorithm to get the next proof...
-    last_block = blockchain.last_block
-    proof = blockchain.proof_of_work(last_block)
-
-    
-
-    # We must receive a reward for finding the proof.
+    # The proof of work runs on the background miner, so we only queue a job.
+    # We must receive a reward for finding the proof, reward() builds its transaction.
     # The sender is "0" to signify that this node has mined a new coin.
-    blockchain.new_transaction_Doctor(
-        PatientID = node_identifier,
-        LabNotes = 'LabNotes',
-        Diagnosis = 'Diagnosis',
-        prescription = 'prescription',
-        recommendation = 'recommendation',
-        
-       
-    
+    def reward():
+        return DoctorTransaction(
+            PatientID = node_identifier,
+            LabNotes = 'LabNotes',
+            Diagnosis = 'Diagnosis',
+            Prescription = 'prescription',
+            recommendation = 'recommendation',
+            
+           
         
-    ) 
+            
+        ) 
 
-    # Forge the new Block by adding it to the chain
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.new_block(proof, previous_hash)
-
-    response = {
-        'message': "New Block Forged",
-        'index': block['index'],
-        'transactions': block['transactions'],
-        'proof': block['proof'],
-        'previous_hash': block['previous_hash'],
-    }
-    return jsonify(response), 200
+    return mining_job_response(miner.submit(reward, request.url_rule.rule))
 
 
 @app.route('/minelab', methods=['Get'])
 def minelab():
-     # We run the proof of work algorithm to get the next proof...
-    last_block = blockchain.last_block
-    proof = blockchain.proof_of_work(last_block)
-
-    
-
-    # We must receive a reward for finding the proof.
+    # The proof of work runs on the background miner, so we only queue a job.
+    # We must receive a reward for finding the proof, reward() builds its transaction.
     # The sender is "0" to signify that this node has mined a new coin.
-    blockchain.new_transaction_Lab(
-        PatientID= 'PatientID',
-        BloodTest = 'BloodTest',
-        Xray = 'Xray',
-        UltraSound= 'UltraSound',
-        Cultures ='Cultures',
-        Lipid = 'Lipid',
-        Hemoglobin = 'Hemoglobin',
-        urinanalysis = 'urinanalysis',
-        other = 'other'
-        
-       
-    
+    def reward():
+        return LabTransaction(
+            PatientID= 'PatientID',
+            BloodTest = 'BloodTest',
+            Xray = 'Xray',
+            UltraSound= 'UltraSound',
+            Cultures ='Cultures',
+            Lipid = 'Lipid',
+            Hemoglobin = 'Hemoglobin',
+            urinanalysis = 'urinanalysis',
+            other = 'other'
+            
+           
         
-    ) 
+            
+        ) 
 
-    # Forge the new Block by adding it to the chain
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.new_block(proof, previous_hash)
-
-    response = {
-        'message': "New Block Forged",
-        'index': block['index'],
-        'transactions': block['transactions'],
-        'proof': block['proof'],
-        'previous_hash': block['previous_hash'],
-    }
-    return jsonify(response), 200
+    return mining_job_response(miner.submit(reward, request.url_rule.rule))
 
 @app.route('/mineDispensary', methods=['Get'])
 def mineDispensary():
-    # We run the proof of work algorithm to get the next proof...
-    last_block = blockchain.last_block
-    proof = blockchain.proof_of_work(last_block)
-
-    
-
-    # We must receive a reward for finding the proof.
+    # The proof of work runs on the background miner, so we only queue a job.
+    # We must receive a reward for finding the proof, reward() builds its transaction.
     # The sender is "0" to signify that this node has mined a new coin.
-    blockchain.new_transaction_Dispensary(
-        
-        Medication = "Medication",
-        PatientID = node_identifier,
-        
-        
-       
-    
+    def reward():
+        return DispensaryTransaction(
+            
+            Medication = "Medication",
+            PatientID = node_identifier,
+            
+            
+           
         
-    ) 
-
-    # Forge the new Block by adding it to the chain
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.new_block(proof, previous_hash)
+            
+        ) 
 
-    response = {
-        'message': "New Block Forged",
-        'index': block['index'],
-        'transactions': block['transactions'],
-        'proof': block['proof'],
-        'previous_hash': block['previous_hash'],
-    }
-    return jsonify(response), 200
+    return mining_job_response(miner.submit(reward, request.url_rule.rule))
 
 
-@app.route('/transactions/newdesk', methods=['POST'])
-def new_transaction_newdesk():
+def create_transaction(transaction_type):
     values = request.get_json()
+    record = TRANSACTION_TYPES[transaction_type]
 
     # Check that the required fields are in the POST'ed data
-    required = ['PatientID', 'PatientName', 'PatientSurname','CovidStatus', 'Temperature', 'DateofCertificate']
-    if not all(k in values for k in required):
+    if not all(k in values for k in record.fields):
         return 'Missing values', 400
 
-    # Create a new Transaction
-    index = blockchain.new_transaction_desk(values['PatientID'],values['PatientName'], values['PatientSurname'], values['CovidStatus'],values['Temperature'], values['DateofCertificate'])
+    # Create a new Transaction, unless this is a retry of one we already have
+    transaction = record.from_dict(values)
+    index, duplicates = blockchain.new_transactions([transaction], [request.headers.get('Idempotency-Key')])
+    if duplicates:
+        return jsonify(duplicate_response(duplicates[0], index)), 200
+    gossip.announce_transactions([transaction])
 
     response = {'message': f'Transaction will be added to Block {index}'}
     return jsonify(response), 201
 
 
-@app.route('/transactions/newadmin', methods=['POST'])
-def new_transactions_newadmin():
-    values = request.get_json()
+def duplicate_response(block_index, next_index):
+    """
+    What a client is told about a transaction it already sent
+    :param block_index: <int> Index of the Block holding the copy we have
+    :param next_index: <int> Index of the next Block to be mined
+    """
+    if block_index >= next_index:
+        message = f'Transaction was already received and will be added to Block {block_index}'
+    else:
+        message = f'Transaction is already in Block {block_index}'
+    return {'message': message, 'duplicate': True, 'index': block_index}
 
-    # Check that the required fields are in the POST'ed data
-    required = ['PatientID',
-                'NextofKin',
-                'Gender',
-                'Age',
-                'DOB',
-                'IDNumber',
-                'MaritalStatus',
-                'EmailAddress',
-                'MedicalAid',
-                'MedicalAidNumber',
-                'ConsultationFee',
-                'TestsFee' ]
-    if not all(k in values for k in required):
-        return 'Missing values', 400
 
-    # Create a new Transaction
-    index = blockchain.new_transaction_admission(values['PatientID'],values['NextofKin'], values['Gender'], values['Age'],values['DOB'], values['IDNumber'],values['MaritalStatus'], values['EmailAddress'],values['MedicalAid'], values['MedicalAidNumber'],values['ConsultationFee'], values['TestsFee'])
+@app.errorhandler(MempoolFull)
+def mempool_full(e):
+    response = {'message': str(e)}
+    return jsonify(response), 429, {'Retry-After': str(e.retry_after)}
 
-    response = {'message': f'Transaction will be added to Block {index}'}
-    return jsonify(response), 201 
 
-@app.route('/transactions/newassessment', methods=['POST'])
-def new_transaction_ass():
-    values = request.get_json()
+@app.route('/mempool', methods=['GET'])
+def mempool_stats():
+    return jsonify(blockchain.mempool.stats()), 200
 
-    # Check that the required fields are in the POST'ed data
-    required = ['PatientID',
-                'Notes', 
-                'Allergies',
-                'Symptoms',
-                'BP',
-                'Pulse',
-                'Temperature',
-                'Respirations',
-                'Oxygen',
-                'Weight',
-                'Height',
-                'PriorityLevel',]
-    if not all(k in values for k in required):
-        return 'Missing values', 400
 
-    # Create a new Transaction
-    index = blockchain.new_transaction_Assessment(values['PatientID'],values['Notes'], values['Allergies'], values['Symptoms'],values['BP'], values['Pulse'],values['Temperature'], values['Respirations'],values['Oxygen'], values['Weight'],values['Height'], values['PriorityLevel'])
+@app.route('/transactions/batch', methods=['POST'])
+def new_transactions_batch():
+    """
+    Add many transactions of any type in one request, sent as a JSON array
+    or as NDJSON (one JSON object per line, Content-Type application/x-ndjson).
+    Every item names its type ('desk', 'admission', 'assessment', 'doctor',
+    'lab' or 'dispensary') in a 'type' field, or is recognised by having
+    exactly the fields of one. Valid items are added, the others reported.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        items = (line for line in request.stream if line.strip())
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            return 'Expected a JSON array of transactions', 400
+
+    records = []
+    keys = []
+    positions = []
+    errors = []
+    for position, item in enumerate(items):
+        try:
+            if isinstance(item, bytes):
+                item = json.loads(item)
+            key = item.pop('idempotency_key', None) if isinstance(item, dict) else None
+            records.append(batch_record(item))
+            keys.append(key)
+            positions.append(position)
+        except ValueError as e:
+            errors.append({'item': position, 'error': str(e)})
+
+    if not records:
+        response = {'accepted': 0, 'errors': errors}
+        return jsonify(response), 400
+
+    index, duplicates = blockchain.new_transactions(records, keys)
+    new = [record for position, record in enumerate(records) if position not in duplicates]
+    if new:
+        gossip.announce_transactions(new)
 
-    response = {'message': f'Transaction will be added to Block {index}'}
-    return jsonify(response), 201 
+    response = {
+        'message': f'Transactions will be added to Block {index}',
+        'accepted': len(new),
+        'duplicates': [
+            {'item': positions[position], 'index': block_index}
+            for position, block_index in sorted(duplicates.items())
+        ],
+        'errors': errors,
+    }
+    return jsonify(response), 201 if new else 200
 
-@app.route('/transactions/newdoctor', methods=['POST'])
-def new_transaction_doc():
-    values = request.get_json()
 
-    # Check that the required fields are in the POST'ed data
-    required = ['PatientID',
-                'LabNotes',
-                'Diagnosis',
-                'Prescription',
-                'recommendation',]
-    if not all(k in values for k in required):
-        return 'Missing values', 400
+def batch_record(values):
+    """
+    The record for one item of a batch
+    :param values: <dict>
+    :return: <Transaction>
+    :raises ValueError: if the item is not a valid transaction
+    """
+    if not isinstance(values, dict):
+        raise ValueError('Not a JSON object')
 
-    # Create a new Transaction
-    index = blockchain.new_transaction_Doctor(values['PatientID'],values['LabNotes'], values['Diagnosis'], values['Prescription'],values['recommendation'],)
+    transaction_type = values.get('type')
+    if transaction_type is None:
+        record = record_from_dict(values)
+        if not isinstance(record, Transaction):
+            raise ValueError('Unknown transaction type')
+        return record
 
-    response = {'message': f'Transaction will be added to Block {index}'}
-    return jsonify(response), 201 
+    record = TRANSACTION_TYPES.get(transaction_type)
+    if record is None:
+        raise ValueError(f'Unknown transaction type {transaction_type!r}')
 
-@app.route('/transactions/newlab', methods=['POST'])
-def new_transaction_labs():
-    values = request.get_json()
+    missing = [k for k in record.fields if k not in values]
+    if missing:
+        raise ValueError(f'Missing values: {", ".join(missing)}')
+    return record.from_dict(values)
 
-    # Check that the required fields are in the POST'ed data
-    required = ['PatientID',
-                'BloodTest',
-                'Xray',
-                'UltraSound',
-                'Cultures',
-                'Lipid',
-                'Hemoglobin',
-                'urinanalysis',
-                'other']
-    if not all(k in values for k in required):
-        return 'Missing values', 400
 
-    # Create a new Transaction
-    index = blockchain.new_transaction_Lab(values['PatientID'],values['BloodTest'], values['Xray'], values['UltraSound'],values['Cultures'],values['Lipid'], values['Hemoglobin'],values['urinanalysis'],values['other'])
+@app.route('/transactions/newdesk', methods=['POST'])
+def new_transaction_newdesk():
+    return create_transaction('desk')
 
-    response = {'message': f'Transaction will be added to Block {index}'}
-    return jsonify(response), 201 
 
-@app.route('/transactions/newDisp', methods=['POST'])
-def new_transaction_disp():
-    values = request.get_json()
+@app.route('/transactions/newadmin', methods=['POST'])
+def new_transactions_newadmin():
+    return create_transaction('admission')
 
-    # Check that the required fields are in the POST'ed data
-    required = ['PatientID',
-                'Medication',]
-    if not all(k in values for k in required):
-        return 'Missing values', 400
 
-    # Create a new Transaction
-    index = blockchain.new_transaction_Dispensary(values['PatientID'],values['Medication'])
+@app.route('/transactions/newassessment', methods=['POST'])
+def new_transaction_ass():
+    return create_transaction('assessment')
+
+
+@app.route('/transactions/newdoctor', methods=['POST'])
+def new_transaction_doc():
+    return create_transaction('doctor')
 
-    response = {'message': f'Transaction will be added to Block {index}'}
-    return jsonify(response), 201
+
+@app.route('/transactions/newlab', methods=['POST'])
+def new_transaction_labs():
+    return create_transaction('lab')
+
+
+@app.route('/transactions/newDisp', methods=['POST'])
+def new_transaction_disp():
+    return create_transaction('dispensary')
+
+
+def chain_response(response, key='chain'):
+    """
+    Add the chain to a response under key.
+    ?start=<block index>&limit=<blocks> only sends that page of it along with
+    the index the next page starts at, and ?stream=true writes the blocks out
+    one by one instead of building the whole payload in memory.
+    """
+    chain = blockchain.chain
+    length = len(chain)
+    response['length'] = length
+
+    start = request.args.get('start', default=1, type=int)
+    limit = request.args.get('limit', type=int)
+    if start < 1:
+        return 'Block indexes start at 1', 400
+    if limit is not None and limit < 0:
+        return 'limit must not be negative', 400
+
+    stop = length + 1 if limit is None else min(length + 1, start + limit)
+    if 'start' in request.args or limit is not None:
+        response['next'] = stop if stop <= length else None
+
+    if request.args.get('stream', default=False, type=lambda value: value.lower() in ('1', 'true', 'yes')):
+        def generate():
+            head = app.json.dumps(response)
+            yield head[:-1] + f', "{key}": ['
+            for position in range(start - 1, stop - 1):
+                yield (', ' if position >= start else '') + app.json.dumps(chain[position])
+            yield ']}'
+
+        return Response(generate(), mimetype='application/json'), 200
+
+    response[key] = chain[start - 1:stop - 1]
+    return encoded_response(response)
+
+
+def encoded_response(response):
+    """
+    A response as JSON, or in the binary Codec encoding for clients that
+    ask for it in their Accept header. Big responses are gzipped for clients
+    that accept it.
+    """
+    if request.accept_mimetypes.best_match(['application/json', Codec.MIMETYPE]) == Codec.MIMETYPE:
+        body = codec.encode(response)
+        mimetype = Codec.MIMETYPE
+    else:
+        body = app.json.dumps(response).encode()
+        mimetype = 'application/json'
+
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    if len(body) >= COMPRESSION_MIN_SIZE and request.accept_encodings['gzip']:
+        # A middling level, most of the size saving for a fraction of the time
+        body = gzip.compress(body, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, status=200, mimetype=mimetype, headers=headers)
 
 
 @app.route('/deskchain', methods=['GET'])
 def full_chain():
+    return chain_response({})
+
+
+@app.route('/chain/tip', methods=['GET'])
+def chain_tip():
+    response = {
+        'length': len(blockchain.chain),
+        'hash': blockchain.last_hash,
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/blocks', methods=['GET'])
+def chain_blocks():
+    # Blocks after the one with the given hash, or from the given block index on
+    after = request.args.get('after')
+    if after is not None:
+        position = blockchain.block_positions.get(after)
+        if position is None:
+            return 'Unknown block hash', 404
+        start = position + 1
+    else:
+        start = request.args.get('from', default=1, type=int) - 1
+        if start < 0:
+            return 'Block indexes start at 1', 400
+
     response = {
-        'chain': blockchain.chain,
+        'blocks': blockchain.chain[start:],
         'length': len(blockchain.chain),
     }
+    return encoded_response(response)
+
+
+@app.route('/patients/<patient_id>/history', methods=['GET'])
+def patient_history(patient_id):
+    records, pending = blockchain.patient_history(patient_id)
+
+    response = {
+        'PatientID': patient_id,
+        'records': [
+            {
+                'block': block['index'],
+                'timestamp': block['timestamp'],
+                'position': position,
+                'transaction': block['transactions'][position],
+            }
+            for block, position in records
+        ],
+        'pending': pending,
+    }
+    return jsonify(response), 200
+
+
+@app.route('/transactions/query', methods=['GET'])
+def query_transactions():
+    """
+    Committed transactions filtered by the time of their Block and by type,
+    eg. /transactions/query?type=lab&from=2021-03-01T18:00&to=2021-03-02T08:00.
+    from and to are Unix timestamps or ISO 8601 times, from is inclusive and
+    to is not. type is one of 'desk', 'admission', 'assessment', 'doctor',
+    'lab' or 'dispensary'. limit caps the number of records.
+    """
+    type_name = request.args.get('type')
+    if type_name is not None and type_name not in TRANSACTION_TYPES:
+        return f'Unknown transaction type {type_name!r}', 400
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 0:
+        return 'limit must not be negative', 400
+    try:
+        start = query_time(request.args.get('from'))
+        end = query_time(request.args.get('to'))
+    except ValueError as e:
+        return str(e), 400
+
+    records = blockchain.query(start, end, type_name, limit)
+    response = {
+        'records': [
+            {
+                'block': block['index'],
+                'timestamp': block['timestamp'],
+                'position': position,
+                'type': transaction_type(block['transactions'][position]),
+                'transaction': block['transactions'][position],
+            }
+            for block, position in records
+        ],
+    }
+    return encoded_response(response)
+
+
+def query_time(value):
+    """
+    A time given in a query as a Unix timestamp or in ISO 8601
+    :return: <float> Unix timestamp, None if value is None
+    :raises ValueError: if value is neither
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f'Invalid time {value!r}, expected a Unix timestamp or an ISO 8601 time') from None
+
+
+@app.route('/blocks/<int:index>/transactions/<int:position>/proof', methods=['GET'])
+def transaction_proof(index, position):
+    if not 1 <= index <= len(blockchain.chain):
+        return 'Unknown block', 404
+    block = blockchain.chain[index - 1]
+    if 'merkle_root' not in block:
+        return 'Block has no Merkle root', 404
+    if not 0 <= position < len(block['transactions']):
+        return 'Unknown transaction', 404
+
+    # Enough for an auditor to check the transaction against the Block hash
+    # without the other transactions: hash the header, then walk the proof
+    # from the transaction up to its merkle_root
+    response = {
+        'transaction': block['transactions'][position],
+        'header': block_header(block),
+        'hash': blockchain.hashes[index - 1],
+        'proof': merkle_proof(block['transactions'], position, block.get('version', 1)),
+    }
     return jsonify(response), 200
 
 
+def gossip_sender(values):
+    # Peers send the port they listen on, their address is where the request came from
+    port = values.get('port')
+    return f'{request.remote_addr}:{port}' if port else None
+
+
+# Type of every field of a Block, checked on Blocks pushed by peers
+BLOCK_FIELD_TYPES = {
+    'index': int,
+    'timestamp': (int, float),
+    'proof': int,
+    'previous_hash': str,
+    'merkle_root': str,
+    'version': int,
+    'transactions': list,
+}
+
+
+def malformed_block(block):
+    """
+    What is wrong with the shape of a Block pushed by a peer
+    :return: <str> or None if every field is there with the right type
+    """
+    if not isinstance(block, dict):
+        return 'Missing block'
+    for field in BLOCK_HEADER_FIELDS + ('version', 'transactions'):
+        kind = BLOCK_FIELD_TYPES[field]
+        if field not in block:
+            return f'Block is missing {field}'
+        if not isinstance(block[field], kind) or isinstance(block[field], bool):
+            return f'Block {field} has the wrong type'
+    if not all(isinstance(transaction, (Transaction, dict)) for transaction in block['transactions']):
+        return 'Block transactions must be objects'
+    return None
+
+
+@app.route('/gossip/block', methods=['POST'])
+def gossip_block():
+    try:
+        values = json.loads(request.get_data(), object_hook=record_from_dict)
+    except ValueError:
+        return 'Expected a JSON object', 400
+    if not isinstance(values, dict):
+        return 'Expected a JSON object', 400
+    block = values.get('block')
+    error = malformed_block(block)
+    if error is not None:
+        return error, 400
+
+    result = gossip.receive_block(block, gossip_sender(values))
+    if result == 'invalid':
+        return 'Invalid block', 400
+
+    response = {'result': result}
+    return jsonify(response), 202
+
+
+@app.route('/gossip/transactions', methods=['POST'])
+def gossip_transactions():
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict) or not isinstance(values.get('transactions', []), list):
+        return 'Expected a JSON object with a list of transactions', 400
+    try:
+        records = [batch_record(item) for item in values.get('transactions', [])]
+    except ValueError as e:
+        return str(e), 400
+
+    accepted = gossip.receive_transactions(records, gossip_sender(values))
+
+    response = {'accepted': accepted}
+    return jsonify(response), 202
+
+
 @app.route('/nodes/register', methods=['POST'])
 def register_nodes():
     values = request.get_json()
@@ -663,15 +2969,32 @@ def consensus():
     if replaced:
         response = {
             'message': 'Our chain was replaced',
-            'new_chain': blockchain.chain
-        }
-    else:
-        response = {
-            'message': 'Our chain is authoritative',
-            'chain': blockchain.chain
         }
+        return chain_response(response, 'new_chain')
 
-    return jsonify(response), 200
+    response = {
+        'message': 'Our chain is authoritative',
+    }
+    return chain_response(response)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Requests the workers answered themselves are only in their metrics
+    text = registry.render()
+    if worker_metrics_dir is not None:
+        text = merge([text] + read_worker_metrics())
+    return Response(text, content_type=Registry.CONTENT_TYPE)
+
+
+# Create the series for every route up front, so they are reported before the first request
+for rule in app.url_map.iter_rules():
+    REQUEST_SECONDS.labels(rule.rule)
+    REQUEST_BYTES.labels(rule.rule)
+    RESPONSE_BYTES.labels(rule.rule)
+    if rule.endpoint in ('mine', 'mineAdmin', 'mineAssessment', 'mineDoc', 'minelab', 'mineDispensary'):
+        BLOCKS_MINED.labels(rule.rule)
+BLOCKS_MINED.labels('seal')
 
 
 if __name__ == '__main__':
@@ -679,9 +3002,74 @@ if __name__ == '__main__':
 
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=8000, type=int, help='port to listen on')
+    parser.add_argument('--difficulty', default=DIFFICULTY, type=int, help='leading hex zeroes a proof of work needs, every node of a network must use the same')
+    parser.add_argument('-w', '--workers', default=os.cpu_count() or 1, type=int, help='number of mining processes')
+    parser.add_argument('--mempool-size', default=100000, type=int, help='most pending transactions before clients are told to retry later')
+    parser.add_argument('--max-block-size', type=int, help='most transactions sealed into one block')
+    parser.add_argument('--duplicate-window', default=DUPLICATE_WINDOW, type=int, help='recently committed transactions and idempotency keys remembered to turn retries away')
+    parser.add_argument('--priority-aging', default=30, type=float, help='seconds a pending transaction waits to move up one priority rank')
+    parser.add_argument('--seal-threshold', default=100, type=int, help='pending transactions that trigger a block')
+    parser.add_argument('-d', '--data-dir', help='directory the chain is stored in, kept in memory only if not given')
+    parser.add_argument('--hot-blocks', type=int, help='newest blocks whose transactions stay in memory, older ones are compressed to disk. All of them stay in memory if not given')
+    parser.add_argument('--cold-dir', help='directory older transactions are compressed to with --hot-blocks, a temporary one if not given')
+    parser.add_argument('--processes', default=1, type=int, help='worker processes serving requests, more than 1 needs --data-dir')
+    parser.add_argument('--full-sync', action='store_true', help='download whole chains from peers during consensus')
+    parser.add_argument('--gossip-fanout', default=GOSSIP_FANOUT, type=int, help='peers new blocks and transactions are pushed to, 0 to only sync on /nodes/resolve')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every block checked during consensus')
+    parser.add_argument('--seal-wait', default=60, type=float, help='seconds a pending transaction waits before a block is sealed')
     args = parser.parse_args()
     port = args.port
-
-    app.run(host='0.0.0.0', port=port)
+    if args.processes > 1 and not args.data_dir:
+        parser.error('--processes needs --data-dir, the workers read the chain from its store')
+    if args.hot_blocks is not None and args.data_dir:
+        parser.error('--hot-blocks is for a chain kept in memory, --data-dir already keeps it on disk')
+
+    DIFFICULTY = args.difficulty
+    blockchain.mining_workers = args.workers
+    blockchain.recent.window = args.duplicate_window
+    if args.data_dir:
+        blockchain.use_store(BlockStore(args.data_dir, Blockchain.hash, default=json_default, object_hook=record_from_dict))
+    elif args.hot_blocks is not None:
+        cold_dir = args.cold_dir
+        if cold_dir is None:
+            cold_dir = tempfile.mkdtemp(prefix='blockchain-')
+            atexit.register(shutil.rmtree, cold_dir, ignore_errors=True)
+        blockchain.use_store(TieredChain(cold_dir, codec.encode, codec.decode, hot_blocks=args.hot_blocks))
+    else:
+        # The genesis block was weighed at the default difficulty when it was created
+        blockchain.work = {block_hash: (position + 1) * block_work() for position, block_hash in enumerate(blockchain.hashes)}
+    blockchain.verbose = args.verbose
+    blockchain.sync_mode = 'full' if args.full_sync else 'delta'
+    blockchain.mempool.capacity = args.mempool_size
+    blockchain.mempool.aging = args.priority_aging
+    blockchain.max_block_size = args.max_block_size
+    miner.seal_threshold = args.seal_threshold
+    miner.max_wait = args.seal_wait
+    gossip.fanout = args.gossip_fanout
+    gossip.port = port
+
+    if args.processes <= 1:
+        miner.start()
+        app.run(host='0.0.0.0', port=port)
+        sys.exit()
+
+    # This process owns the chain, mempool and miner and only listens on a
+    # local port. The workers serve the public port, answer chain reads from
+    # the store and forward the rest here. They are forked before the miner
+    # and the pools start any threads.
+    listener = socket.create_server(('0.0.0.0', port), backlog=128)
+    internal = socket.create_server(('127.0.0.1', 0))
+    owner_address = f'127.0.0.1:{internal.getsockname()[1]}'
+    worker_metrics_dir = os.path.join(args.data_dir, 'metrics')
+    os.makedirs(worker_metrics_dir, exist_ok=True)
+    for name in os.listdir(worker_metrics_dir):
+        os.remove(os.path.join(worker_metrics_dir, name))
+    start_workers(args.processes, listener, owner_address, args.data_dir)
+    listener.close()
+
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+    miner.start()
+    print(f' * {args.processes} workers serving http://0.0.0.0:{port}, chain owner on {owner_address}')
+    make_server('127.0.0.1', 0, app, threaded=True, fd=internal.fileno()).serve_forever()
 
     
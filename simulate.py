@@ -0,0 +1,361 @@
+"""
+Cluster simulator for the blockchain node
+
+run "python simulate.py" to start a few nodes on free localhost ports,
+register them with each other, put them under transaction and mining load
+and report how fast they agree on one chain, how many mined blocks ended up
+orphaned and how many bytes the nodes exchanged per block. Results can be
+saved with "-o results.json" and compared against with "-b results.json",
+like benchmark.py.
+"""
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+from argparse import ArgumentParser
+from time import perf_counter, sleep
+
+import requests
+
+from benchmark import compare
+
+# Routes the nodes use to talk to each other, their traffic is what a block costs the network
+PEER_ROUTES = ('/chain/tip', '/chain/blocks', '/deskchain', '/gossip/block', '/gossip/transactions')
+
+
+def free_port():
+    """
+    A localhost port nothing listens on right now
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read_metrics(text):
+    """
+    Parse the Prometheus text format served on /metrics
+    :return: <dict> series name with its labels -> value
+    """
+    metrics = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            series, value = line.rsplit(' ', 1)
+            metrics[series] = float(value)
+    return metrics
+
+
+class Node:
+    """
+    One node of the cluster, a project.py process on its own port
+    """
+
+    def __init__(self, port, options, log=None):
+        self.port = port
+        self.address = f'127.0.0.1:{port}'
+        self.url = f'http://{self.address}'
+        self.session = requests.Session()
+        self.process = subprocess.Popen(
+            [sys.executable, 'project.py', '-p', str(port)] + options,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=log or subprocess.DEVNULL,
+            stderr=subprocess.STDOUT,
+        )
+
+    def get(self, path, **kwargs):
+        return self.session.get(self.url + path, timeout=30, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.session.post(self.url + path, timeout=30, **kwargs)
+
+    def tip(self):
+        return self.get('/chain/tip').json()
+
+    def metrics(self):
+        return read_metrics(self.get('/metrics').text)
+
+    def wait_until_up(self, timeout):
+        started = perf_counter()
+        while perf_counter() - started < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'node on port {self.port} exited with {self.process.returncode}')
+            try:
+                self.tip()
+                return
+            except requests.ConnectionError:
+                sleep(0.1)
+        raise RuntimeError(f'node on port {self.port} did not come up')
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class Cluster:
+    """
+    N nodes that all know each other, with what the simulator needs to watch them
+    """
+
+    def __init__(self, size, options, log=None):
+        self.nodes = [Node(free_port(), options, log) for _ in range(size)]
+
+        # When every node first saw every tip, to time how far blocks spread
+        self.first_seen = {}
+        self.tip_bytes = 0
+        self._tip_bytes_lock = threading.Lock()
+        self._watching = False
+        self._watcher = None
+
+    def start(self, timeout=30):
+        for node in self.nodes:
+            node.wait_until_up(timeout)
+        for node in self.nodes:
+            peers = [other.address for other in self.nodes if other is not node]
+            node.post('/nodes/register', json={'nodes': peers})
+
+    def stop(self):
+        self.stop_watching()
+        for node in self.nodes:
+            node.stop()
+
+    def tips(self):
+        """
+        The tip of every node, with the time its answer came in as 'seen_at'
+        """
+        tips = []
+        for node in self.nodes:
+            response = node.get('/chain/tip')
+            tip = response.json()
+            tip['seen_at'] = perf_counter()
+            with self._tip_bytes_lock:
+                self.tip_bytes += len(response.content)
+            tips.append(tip)
+        return tips
+
+    def converged(self):
+        return len({tip['hash'] for tip in self.tips()}) == 1
+
+    def watch(self, interval):
+        """
+        Poll every node's tip in the background, recording when it first had each one
+        """
+        def run():
+            while self._watching:
+                for node, tip in zip(self.nodes, self.tips()):
+                    self.first_seen.setdefault(tip['hash'], {}).setdefault(node.port, tip['seen_at'])
+                sleep(interval)
+
+        self._watching = True
+        self._watcher = threading.Thread(target=run, daemon=True)
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._watching = False
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def propagation_times(self, final_hashes):
+        """
+        Seconds between the first and the last node having each block of the
+        final chain, for the blocks every node was seen holding as its tip
+        """
+        times = []
+        for block_hash in final_hashes:
+            seen = self.first_seen.get(block_hash, {})
+            if len(seen) == len(self.nodes):
+                times.append(max(seen.values()) - min(seen.values()))
+        return times
+
+    def peer_bytes(self):
+        """
+        Bytes the nodes sent each other, without the simulator's own tip polling
+        """
+        total = 0
+        for node in self.nodes:
+            for series, value in node.metrics().items():
+                if series.startswith(('http_request_bytes_total', 'http_response_bytes_total')):
+                    if any(f'route="{route}"' in series for route in PEER_ROUTES):
+                        total += value
+        return total - self.tip_bytes
+
+
+def send_transactions(cluster, count, rate, batch_size):
+    """
+    Post count desk transactions to random nodes, about rate per second
+    :return: <int> transactions the nodes accepted
+    """
+    accepted = 0
+    sent = 0
+    started = perf_counter()
+    while sent < count:
+        batch = [
+            {
+                'type': 'desk',
+                'PatientID': sent + i,
+                'PatientName': f'Patient {sent + i}',
+                'PatientSurname': 'Simulated',
+                'CovidStatus': 'Negative',
+                'Temperature': '36.6',
+                'DateofCertificate': '2021-01-01',
+            }
+            for i in range(min(batch_size, count - sent))
+        ]
+        response = random.choice(cluster.nodes).post('/transactions/batch', json=batch)
+        if response.status_code == 201:
+            accepted += response.json()['accepted']
+        sent += len(batch)
+
+        # Keep to the rate on average
+        ahead = sent / rate - (perf_counter() - started)
+        if ahead > 0:
+            sleep(ahead)
+    return accepted
+
+
+def mine_blocks(cluster, miners, blocks, interval):
+    """
+    Ask miners in turn for blocks, interval seconds apart, and wait for them all
+    """
+    jobs = []
+    for i in range(blocks):
+        node = miners[i % len(miners)]
+        jobs.append((node, node.get('/mine').json()['status']))
+        sleep(interval)
+
+    for node, status in jobs:
+        while node.get(status).json()['status'] in ('queued', 'mining'):
+            sleep(0.05)
+
+
+def simulate(args):
+    log = open(args.log, 'a') if args.log else None
+    options = [
+        '-w', '1',
+        '--difficulty', str(args.difficulty),
+        '--gossip-fanout', str(args.gossip_fanout),
+        '--seal-threshold', str(args.seal_threshold),
+        '--seal-wait', str(args.seal_wait),
+    ]
+    cluster = Cluster(args.nodes, options, log)
+    try:
+        cluster.start()
+
+        # Every node starts with its own genesis block, agree on one first
+        for node in cluster.nodes:
+            node.get('/nodes/resolve')
+        cluster.nodes[0].get('/mine')
+        while not cluster.converged():
+            for node in cluster.nodes:
+                node.get('/nodes/resolve')
+            sleep(args.poll_interval)
+        start_metrics = [node.metrics() for node in cluster.nodes]
+        start_length = cluster.tips()[0]['length']
+        start_bytes = cluster.peer_bytes()
+
+        cluster.watch(args.poll_interval)
+        started = perf_counter()
+        miners = cluster.nodes[:args.miners]
+        load = threading.Thread(target=mine_blocks, args=(cluster, miners, args.blocks, args.mine_interval))
+        load.start()
+        send_transactions(cluster, args.transactions, args.rate, args.batch_size)
+        load.join()
+        load_time = perf_counter() - started
+
+        # Let the network settle. Without gossip the nodes only learn of new
+        # blocks by resolving, and two tips with the same work stay split
+        # until another block breaks the tie.
+        settle_started = perf_counter()
+        last_progress = settle_started
+        last_tips = None
+        while not cluster.converged():
+            if args.gossip_fanout == 0:
+                for node in cluster.nodes:
+                    node.get('/nodes/resolve')
+            tips = {tip['hash'] for tip in cluster.tips()}
+            if tips != last_tips:
+                last_tips = tips
+                last_progress = perf_counter()
+            elif perf_counter() - last_progress > args.tie_break:
+                mine_blocks(cluster, miners[:1], 1, 0)
+                last_progress = perf_counter()
+            sleep(args.poll_interval)
+        convergence = perf_counter() - settle_started
+        cluster.stop_watching()
+
+        # Before the simulator downloads anything itself, which is not peer traffic
+        peer_bytes = cluster.peer_bytes() - start_bytes
+
+        final = cluster.nodes[0]
+        final_tip = cluster.tips()[0]
+        final_length = final_tip['length']
+        values = final.get('/chain/blocks', params={'from': start_length + 1}, headers={'Accept': 'application/json'}).json()
+        final_hashes = [block['previous_hash'] for block in values['blocks'][1:]] + [final_tip['hash']]
+
+        mined = 0
+        for node, before in zip(cluster.nodes, start_metrics):
+            for series, value in node.metrics().items():
+                if series.startswith('blockchain_blocks_mined_total'):
+                    mined += value - before.get(series, 0)
+        new_blocks = final_length - start_length
+        orphaned = mined - new_blocks
+        propagation = cluster.propagation_times(final_hashes)
+        committed = sum(len(block['transactions']) for block in values['blocks'])
+
+        return {
+            'load_s': load_time,
+            'convergence_s': convergence,
+            'orphaned_blocks': orphaned,
+            'orphaned_work_ratio': orphaned / mined if mined else 0.0,
+            'block_propagation_mean_s': sum(propagation) / len(propagation) if propagation else 0.0,
+            'block_propagation_max_s': max(propagation, default=0.0),
+            'peer_bytes_per_block': peer_bytes / new_blocks if new_blocks else 0.0,
+            'throughput_tx_per_s': committed / (load_time + convergence),
+        }
+    finally:
+        cluster.stop()
+        if log is not None:
+            log.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--nodes', default=4, type=int, help='nodes in the cluster')
+    parser.add_argument('-m', '--miners', default=2, type=int, help='nodes that are asked to mine')
+    parser.add_argument('--blocks', default=10, type=int, help='mining requests sent during the run')
+    parser.add_argument('--mine-interval', default=0.5, type=float, help='seconds between mining requests')
+    parser.add_argument('-t', '--transactions', default=2000, type=int, help='transactions sent during the run')
+    parser.add_argument('--rate', default=500, type=float, help='transactions sent per second')
+    parser.add_argument('--batch-size', default=50, type=int, help='transactions per /transactions/batch request')
+    parser.add_argument('--difficulty', default=4, type=int, help='proof of work difficulty of the nodes')
+    parser.add_argument('--gossip-fanout', default=8, type=int, help='gossip fan-out of the nodes, 0 to sync with /nodes/resolve only')
+    parser.add_argument('--seal-threshold', default=100, type=int, help='pending transactions that make a node seal a block')
+    parser.add_argument('--seal-wait', default=60, type=float, help='seconds a transaction waits before a node seals a block')
+    parser.add_argument('--poll-interval', default=0.05, type=float, help='seconds between checks of the nodes\' tips')
+    parser.add_argument('--tie-break', default=5, type=float, help='seconds without progress before a block is mined to settle a tie')
+    parser.add_argument('--log', help='append the output of the nodes to this file')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='compare against results saved with -o')
+    parser.add_argument('--tolerance', default=0.25, type=float, help='change against the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    results = simulate(args)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+
+    if regressions:
+        sys.exit(1)
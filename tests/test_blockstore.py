@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+
+from blockstore import BlockStore
+
+
+def block_hash(block):
+    return hashlib.sha256(json.dumps(block, sort_keys=True).encode()).hexdigest()
+
+
+def make_blocks(start, stop):
+    return [{'index': index, 'transactions': [f'record {index}']} for index in range(start, stop)]
+
+
+def open_store(path, **kwargs):
+    return BlockStore(str(path), block_hash, sync=False, **kwargs)
+
+
+def fill(path, blocks):
+    store = open_store(path)
+    store.extend(blocks, [block_hash(block) for block in blocks])
+    store.close()
+
+
+def test_reopen_keeps_blocks(tmp_path):
+    blocks = make_blocks(0, 5)
+    fill(tmp_path, blocks)
+
+    store = open_store(tmp_path)
+    assert list(store) == blocks
+    assert store.hashes == [block_hash(block) for block in blocks]
+    assert store[-1] == blocks[-1]
+    assert store[1:3] == blocks[1:3]
+
+
+def test_partial_record_is_cut_off(tmp_path):
+    blocks = make_blocks(0, 3)
+    fill(tmp_path, blocks)
+    segment_path = tmp_path / 'blocks.dat'
+    size = os.path.getsize(segment_path)
+
+    # A crash while the last record was written leaves only part of it
+    with open(segment_path, 'r+b') as f:
+        f.truncate(size - 5)
+
+    store = open_store(tmp_path)
+    assert list(store) == blocks[:2]
+    assert os.path.getsize(tmp_path / 'blocks.idx') == 2 * BlockStore.INDEX_ENTRY.size
+
+    # The store keeps working after the repair
+    store.append(blocks[2], block_hash(blocks[2]))
+    store.close()
+    assert list(open_store(tmp_path)) == blocks
+
+
+def test_record_without_index_entry_is_indexed_again(tmp_path):
+    blocks = make_blocks(0, 4)
+    fill(tmp_path, blocks)
+
+    # A crash after the record was written but before its index entry
+    with open(tmp_path / 'blocks.idx', 'r+b') as f:
+        f.truncate(3 * BlockStore.INDEX_ENTRY.size)
+
+    store = open_store(tmp_path)
+    assert list(store) == blocks
+    assert store.hashes[-1] == block_hash(blocks[-1])
+    assert os.path.getsize(tmp_path / 'blocks.idx') == 4 * BlockStore.INDEX_ENTRY.size
+
+
+def test_short_index_entry_is_replaced(tmp_path):
+    blocks = make_blocks(0, 4)
+    fill(tmp_path, blocks)
+
+    # Only part of the last index entry made it to disk
+    with open(tmp_path / 'blocks.idx', 'r+b') as f:
+        f.truncate(4 * BlockStore.INDEX_ENTRY.size - 7)
+
+    store = open_store(tmp_path)
+    assert list(store) == blocks
+    assert store.hashes == [block_hash(block) for block in blocks]
+
+
+def test_index_entry_of_a_lost_record_is_dropped(tmp_path):
+    blocks = make_blocks(0, 3)
+    fill(tmp_path, blocks)
+
+    # The index points at a record whose bytes never made it to disk
+    segment_path = tmp_path / 'blocks.dat'
+    with open(segment_path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xff]))
+
+    store = open_store(tmp_path)
+    assert list(store) == blocks[:2]
+    assert os.path.getsize(tmp_path / 'blocks.idx') == 2 * BlockStore.INDEX_ENTRY.size
+
+
+def test_truncate(tmp_path):
+    blocks = make_blocks(0, 5)
+    fill(tmp_path, blocks)
+
+    store = open_store(tmp_path)
+    store.truncate(2)
+    assert list(store) == blocks[:2]
+    replacement = make_blocks(10, 12)
+    store.extend(replacement, [block_hash(block) for block in replacement])
+    store.close()
+
+    assert list(open_store(tmp_path)) == blocks[:2] + replacement
+
+
+def test_readonly_refresh_sees_appends(tmp_path):
+    blocks = make_blocks(0, 3)
+    writer = open_store(tmp_path)
+    writer.extend(blocks[:2], [block_hash(block) for block in blocks[:2]])
+    reader = open_store(tmp_path, readonly=True)
+    assert list(reader) == blocks[:2]
+
+    writer.append(blocks[2], block_hash(blocks[2]))
+    assert reader.refresh() == 2
+    assert list(reader) == blocks
+
+
+def test_readonly_refresh_after_truncate(tmp_path):
+    blocks = make_blocks(0, 5)
+    writer = open_store(tmp_path)
+    writer.extend(blocks, [block_hash(block) for block in blocks])
+    reader = open_store(tmp_path, readonly=True)
+    assert list(reader) == blocks
+
+    # The writer switches to another branch after the third block
+    writer.truncate(3)
+    replacement = make_blocks(20, 23)
+    writer.extend(replacement, [block_hash(block) for block in replacement])
+
+    assert reader.refresh() == 3
+    assert list(reader) == blocks[:3] + replacement
+    assert reader.hashes == [block_hash(block) for block in blocks[:3] + replacement]
+
+
+def test_readonly_refresh_after_shorter_truncate(tmp_path):
+    blocks = make_blocks(0, 5)
+    writer = open_store(tmp_path)
+    writer.extend(blocks, [block_hash(block) for block in blocks])
+    reader = open_store(tmp_path, readonly=True)
+    list(reader)
+
+    writer.truncate(2)
+    assert reader.refresh() == 2
+    assert list(reader) == blocks[:2]
@@ -0,0 +1,125 @@
+import json
+
+import pytest
+
+from codec import Codec
+from project import (
+    TRANSACTION_TYPES,
+    Blockchain,
+    DeskTransaction,
+    LabTransaction,
+    codec,
+    json_default,
+    merkle_root,
+    record_from_dict,
+)
+
+
+def desk(patient_id):
+    return DeskTransaction(
+        PatientID=patient_id,
+        PatientName=f'Patient {patient_id}',
+        PatientSurname='Test',
+        CovidStatus='Negative',
+        Temperature='36.6',
+        DateofCertificate='2021-01-01',
+    )
+
+
+def make_block(transactions):
+    block = {
+        'index': 2,
+        'timestamp': 1600000000.5,
+        'proof': 12345,
+        'previous_hash': 'ab' * 32,
+        'version': 2,
+        'transactions': transactions,
+    }
+    block['merkle_root'] = merkle_root(transactions)
+    return block
+
+
+@pytest.mark.parametrize('value', [
+    None,
+    True,
+    False,
+    0,
+    127,
+    128,
+    2 ** 70,
+    -1,
+    -(2 ** 70),
+    0.0,
+    -1.5,
+    1e300,
+    '',
+    'Zimbabwe',
+    'ü' * 200,
+    b'\x00\xff',
+    [],
+    [1, 'two', [3.0, None]],
+    {},
+    {'b': {'c': [1, 2]}, 'a': ''},
+])
+def test_round_trip(value):
+    assert Codec().decode(Codec().encode(value)) == value
+
+
+def test_tuple_decodes_as_list():
+    assert Codec().decode(Codec().encode((1, 2))) == [1, 2]
+
+
+def test_encoding_is_pinned():
+    # Blocks are hashed in this encoding, changing it changes every hash
+    assert Codec().encode({'b': [1, -2, 300], 'a': 'x'}) == b'm\x02\x01as\x01x\x01bl\x03i\x01n\x02i\xac\x02'
+
+
+def test_key_order_does_not_matter():
+    assert Codec().encode({'a': 1, 'b': 2}) == Codec().encode({'b': 2, 'a': 1})
+
+
+def test_records_round_trip():
+    records = [desk(1), LabTransaction(**{field: 'x' for field in LabTransaction.fields})]
+    assert codec.decode(codec.encode(records)) == records
+
+
+def test_unknown_values_are_refused():
+    with pytest.raises(TypeError):
+        Codec().encode(object())
+    with pytest.raises(TypeError):
+        Codec().encode({1: 'not a string key'})
+    with pytest.raises(TypeError):
+        Codec().encode(desk(1))
+
+
+@pytest.mark.parametrize('data', [b'', b'?', b's\x05abc', b'l\x02i\x01', b'i\x01i\x01'])
+def test_invalid_encodings_raise_value_error(data):
+    with pytest.raises(ValueError):
+        Codec().decode(data)
+
+
+def test_block_hash_is_stable():
+    block = make_block([desk(1)])
+    assert block['merkle_root'] == '7cfc5bb95f18103e6cc19cd4fee5c21d16fa76091804192b260793972c7b53ae'
+    assert Blockchain.hash(block) == '1eb227873eba533814f29080df0b77f7e883f4db4dc516b5872001e27e187af1'
+
+
+def test_block_hash_survives_the_wire():
+    block = make_block([desk(patient_id) for patient_id in range(5)])
+
+    from_json = json.loads(json.dumps(block, default=json_default), object_hook=record_from_dict)
+    from_codec = codec.decode(codec.encode(block), object_hook=record_from_dict)
+    reordered = dict(reversed(list(block.items())))
+
+    assert Blockchain.hash(from_json) == Blockchain.hash(block)
+    assert Blockchain.hash(from_codec) == Blockchain.hash(block)
+    assert Blockchain.hash(reordered) == Blockchain.hash(block)
+    assert merkle_root(from_json['transactions']) == block['merkle_root']
+    assert codec.encode(from_codec) == codec.encode(block)
+
+
+def test_every_transaction_type_round_trips():
+    for record_type in TRANSACTION_TYPES.values():
+        record = record_type(**{field: f'{field} value' for field in record_type.fields})
+        assert codec.decode(codec.encode(record)) == record
+        assert record_from_dict(record.to_dict()) == record
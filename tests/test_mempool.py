@@ -0,0 +1,135 @@
+import pytest
+
+import project
+from project import AssessmentTransaction, DeskTransaction, Mempool, MempoolFull, transaction_hash
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    The time the mempool sees, moved on by hand
+    """
+    now = [1000.0]
+    monkeypatch.setattr(project, 'time', lambda: now[0])
+    return now
+
+
+def desk(patient_id):
+    return DeskTransaction(
+        PatientID=patient_id,
+        PatientName=f'Patient {patient_id}',
+        PatientSurname='Test',
+        CovidStatus='Negative',
+        Temperature='36.6',
+        DateofCertificate='2021-01-01',
+    )
+
+
+def assessment(patient_id, level):
+    fields = {field: '' for field in AssessmentTransaction.fields}
+    fields.update(PatientID=patient_id, PriorityLevel=level)
+    return AssessmentTransaction(**fields)
+
+
+def test_full_mempool_refuses_the_whole_batch():
+    mempool = Mempool(capacity=3, retry_after=7)
+    mempool.add_many([desk(0), desk(1)])
+
+    with pytest.raises(MempoolFull) as raised:
+        mempool.add_many([desk(2), desk(3)])
+    assert raised.value.retry_after == 7
+    assert len(mempool) == 2
+    assert mempool.stats()['rejected'] == 2
+
+    mempool.add(desk(2))
+    assert len(mempool) == 3
+
+
+def test_forced_transaction_goes_in_when_full_and_first():
+    mempool = Mempool(capacity=1)
+    mempool.add(desk(0))
+    mempool.add(desk(1), force=True)
+    assert mempool.take() == [desk(1), desk(0)]
+
+
+def test_take_respects_the_limit(clock):
+    mempool = Mempool()
+    for patient_id in range(5):
+        mempool.add(desk(patient_id))
+        clock[0] += 1
+
+    assert mempool.take(2) == [desk(0), desk(1)]
+    assert len(mempool) == 3
+    assert mempool.pending() == [desk(2), desk(3), desk(4)]
+    assert mempool.take() == [desk(2), desk(3), desk(4)]
+    assert len(mempool) == 0
+
+
+def test_discard_drops_one_copy_per_hash():
+    mempool = Mempool()
+    mempool.add_many([desk(0), desk(0), desk(1)])
+
+    mempool.discard([transaction_hash(desk(0))])
+    assert mempool.pending() == [desk(0), desk(1)]
+    assert transaction_hash(desk(0)) in mempool
+
+    mempool.discard([transaction_hash(desk(0)), transaction_hash(desk(1))])
+    assert len(mempool) == 0
+    assert transaction_hash(desk(0)) not in mempool
+
+
+def test_oldest_wait_skips_taken_transactions(clock):
+    mempool = Mempool()
+    mempool.add(desk(0))
+    clock[0] += 10
+    mempool.add(desk(1))
+    clock[0] += 5
+    assert mempool.oldest_wait() == 15
+
+    mempool.take(1)
+    assert mempool.oldest_wait() == 5
+    mempool.take()
+    assert mempool.oldest_wait() == 0
+
+
+def test_urgent_records_go_first(clock):
+    mempool = Mempool()
+    mempool.add(desk(0))
+    mempool.add(assessment(1, 'Standard'))
+    mempool.add(assessment(2, 'Red'))
+    mempool.add(assessment(3, '2'))
+
+    assert mempool.take() == [assessment(2, 'Red'), assessment(3, '2'), assessment(1, 'Standard'), desk(0)]
+
+
+def test_same_priority_keeps_arrival_order(clock):
+    mempool = Mempool()
+    for patient_id in range(5):
+        mempool.add(assessment(patient_id, 'urgent'))
+    assert mempool.take() == [assessment(patient_id, 'urgent') for patient_id in range(5)]
+
+
+def test_waiting_records_are_not_starved(clock):
+    mempool = Mempool(aging=30)
+    mempool.add(desk(0))
+
+    # A routine record has waited less than four ranks' worth of aging
+    clock[0] += 4 * 30 - 1
+    mempool.add(assessment(1, 'emergency'))
+    assert mempool.take(1) == [assessment(1, 'emergency')]
+
+    # Once it has waited longer, it goes ahead of a burst of new emergencies
+    clock[0] += 2
+    mempool.add_many([assessment(patient_id, 'emergency') for patient_id in range(2, 5)])
+    assert mempool.take(1) == [desk(0)]
+
+
+def test_waits_are_reported_by_priority(clock):
+    mempool = Mempool()
+    mempool.add(desk(0))
+    mempool.add(assessment(1, 'red'))
+    clock[0] += 4
+    mempool.take()
+
+    assert mempool.stats()['mean_wait_by_priority'] == {'0': 4, '4': 4}
+    assert mempool.stats()['last_block_max_wait'] == 4
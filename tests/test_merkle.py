@@ -0,0 +1,41 @@
+import pytest
+
+from project import DeskTransaction, merkle_proof, merkle_root, verify_merkle_proof
+
+
+def desk(patient_id):
+    return DeskTransaction(
+        PatientID=patient_id,
+        PatientName=f'Patient {patient_id}',
+        PatientSurname='Test',
+        CovidStatus='Negative',
+        Temperature='36.6',
+        DateofCertificate='2021-01-01',
+    )
+
+
+@pytest.mark.parametrize('size', range(1, 14))
+def test_every_proof_leads_to_the_root(size):
+    transactions = [desk(patient_id) for patient_id in range(size)]
+    root = merkle_root(transactions)
+    for position, transaction in enumerate(transactions):
+        assert verify_merkle_proof(transaction, merkle_proof(transactions, position), root)
+
+
+@pytest.mark.parametrize('size', [2, 5, 8])
+def test_proof_does_not_fit_another_transaction(size):
+    transactions = [desk(patient_id) for patient_id in range(size)]
+    root = merkle_root(transactions)
+    assert not verify_merkle_proof(desk(size), merkle_proof(transactions, 0), root)
+    assert not verify_merkle_proof(transactions[1], merkle_proof(transactions, 0), root)
+
+
+def test_proof_is_logarithmic():
+    transactions = [desk(patient_id) for patient_id in range(1000)]
+    assert len(merkle_proof(transactions, 999)) <= 10
+
+
+def test_dict_hashes_like_its_record():
+    transactions = [desk(patient_id) for patient_id in range(3)]
+    root = merkle_root(transactions)
+    assert verify_merkle_proof(transactions[2].to_dict(), merkle_proof(transactions, 2), root)
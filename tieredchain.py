@@ -0,0 +1,155 @@
+import glob
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+
+class TieredChain:
+    """
+    In-memory chain that keeps every block header in memory but only the
+    transactions of the newest blocks.
+
+    Once more than hot_blocks blocks follow the last cold segment, the
+    transactions of the oldest segment_blocks of them are encoded together,
+    compressed and written to a segment file. Reading an old block loads its
+    whole segment back, and the last few segments read are kept decoded, so
+    walking the chain in order reads every segment once.
+
+    The segment files are only a place to spill to, not a copy of the chain
+    that survives a restart: any found in path are removed on open. It has
+    the interface of a BlockStore, so Blockchain.use_store can keep the
+    chain in it.
+    """
+
+    def __init__(self, path, encode, decode, hot_blocks=1000, segment_blocks=100, cache_segments=16):
+        """
+        :param path: Directory segment files are written to, created if missing
+        :param encode: <callable> Turns a list of transaction lists into bytes
+        :param decode: <callable> Turns those bytes back into the list
+        :param hot_blocks: <int> Newest blocks whose transactions stay in memory
+        :param segment_blocks: <int> Blocks whose transactions go in one segment file
+        :param cache_segments: <int> Number of decoded segments kept in memory
+        """
+        os.makedirs(path, exist_ok=True)
+        for segment_path in glob.glob(os.path.join(path, 'bodies-*.dat')):
+            os.remove(segment_path)
+        self.path = path
+        self.encode = encode
+        self.decode = decode
+        self.hot_blocks = hot_blocks
+        self.segment_blocks = segment_blocks
+        self.cache_segments = cache_segments
+
+        #every block without its transactions, and its hash
+        self.headers = []
+        self.hashes = []
+        #block position -> transactions, for the blocks after the cold ones
+        self._hot = {}
+        #number of leading blocks whose transactions are in segment files
+        self.cold_length = 0
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[position] for position in range(*key.indices(len(self)))]
+
+        with self._lock:
+            if key < 0:
+                key += len(self.headers)
+            if not 0 <= key < len(self.headers):
+                raise IndexError('chain index out of range')
+
+            block = dict(self.headers[key])
+            if key >= self.cold_length:
+                block['transactions'] = self._hot[key]
+            else:
+                segment, offset = divmod(key, self.segment_blocks)
+                block['transactions'] = self._segment(segment)[offset]
+            return block
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def append(self, block, block_hash):
+        """
+        Append a Block to the end of the chain
+        :param block: Block
+        :param block_hash: <str> Hash of the Block
+        """
+        self.extend([block], [block_hash])
+
+    def extend(self, blocks, hashes):
+        """
+        Append Blocks to the end of the chain
+        :param blocks: <list> Blocks
+        :param hashes: <list> Hash of every Block
+        """
+        with self._lock:
+            for block, block_hash in zip(blocks, hashes):
+                self._hot[len(self.headers)] = block['transactions']
+                self.headers.append({field: value for field, value in block.items() if field != 'transactions'})
+                self.hashes.append(block_hash)
+
+            while len(self.headers) - self.cold_length >= self.hot_blocks + self.segment_blocks:
+                self._spill()
+
+    def truncate(self, length):
+        """
+        Drop every block after the first length blocks
+        :param length: <int> Number of blocks to keep
+        """
+        with self._lock:
+            if length >= len(self.headers):
+                return
+
+            if length < self.cold_length:
+                # The blocks kept from the first segment that changes become hot again
+                first = length // self.segment_blocks
+                start = first * self.segment_blocks
+                for offset, transactions in enumerate(self._segment(first)[:length - start]):
+                    self._hot[start + offset] = transactions
+                for segment in range(first, self.cold_length // self.segment_blocks):
+                    os.remove(self._segment_path(segment))
+                    self._cache.pop(segment, None)
+                self.cold_length = start
+
+            for position in range(length, len(self.headers)):
+                self._hot.pop(position, None)
+            del self.headers[length:]
+            del self.hashes[length:]
+
+    def _spill(self):
+        """
+        Move the transactions of the oldest hot blocks to a new segment file
+        """
+        start = self.cold_length
+        segment = start // self.segment_blocks
+        bodies = [self._hot.pop(position) for position in range(start, start + self.segment_blocks)]
+        with open(self._segment_path(segment), 'wb') as f:
+            f.write(zlib.compress(self.encode(bodies), 6))
+        self.cold_length += self.segment_blocks
+
+    def _segment(self, segment):
+        """
+        The transactions of every block in a segment, read from its file when not cached
+        """
+        bodies = self._cache.get(segment)
+        if bodies is not None:
+            self._cache.move_to_end(segment)
+            return bodies
+
+        with open(self._segment_path(segment), 'rb') as f:
+            bodies = self.decode(zlib.decompress(f.read()))
+        self._cache[segment] = bodies
+        while len(self._cache) > self.cache_segments:
+            self._cache.popitem(last=False)
+        return bodies
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f'bodies-{segment:08d}.dat')